@@ -0,0 +1,127 @@
+import math
+import torch
+
+''' Batched point cloud augmentation on torch tensors, applied in place on the tensor's device.
+    Every transform works on a BxNxC batch (channels last, xyz in columns 0:3) and its BxN labels,
+    so a training batch is augmented right after it is moved to the GPU, without a host round-trip.
+    Rigid transforms keep all distances between points unchanged.
+'''
+
+
+class RandomRotateZ():
+    """ Randomly rotate every point cloud around the up axis, one bmm for the whole batch
+        Same rotation as provider.rotate_point_cloud_z
+    """
+    rigid = True
+
+    def __call__(self, points, target):
+        B = points.shape[0]
+        angles = torch.rand(B, device=points.device) * 2 * math.pi
+        cosval, sinval = torch.cos(angles), torch.sin(angles)
+        rotation = torch.zeros(B, 3, 3, device=points.device, dtype=points.dtype)
+        rotation[:, 0, 0] = cosval
+        rotation[:, 0, 1] = sinval
+        rotation[:, 1, 0] = -sinval
+        rotation[:, 1, 1] = cosval
+        rotation[:, 2, 2] = 1
+        points[:, :, 0:3] = torch.bmm(points[:, :, 0:3], rotation)
+        return points, target
+
+
+class RandomJitter():
+    """ Randomly jitter every point, clipped Gaussian noise as provider.jitter_point_cloud
+    """
+    rigid = False
+
+    def __init__(self, sigma=0.01, clip=0.05):
+        assert clip > 0
+        self.sigma = sigma
+        self.clip = clip
+
+    def __call__(self, points, target):
+        noise = torch.randn_like(points[:, :, 0:3]).mul_(self.sigma).clamp_(-self.clip, self.clip)
+        points[:, :, 0:3] += noise
+        return points, target
+
+
+class RandomScale():
+    """ Randomly scale every point cloud, as provider.random_scale_point_cloud
+    """
+    rigid = False
+
+    def __init__(self, scale_low=0.8, scale_high=1.25):
+        self.scale_low = scale_low
+        self.scale_high = scale_high
+
+    def __call__(self, points, target):
+        B = points.shape[0]
+        scales = torch.empty(B, 1, 1, device=points.device, dtype=points.dtype).uniform_(self.scale_low, self.scale_high)
+        points[:, :, 0:3] *= scales
+        return points, target
+
+
+class RandomShift():
+    """ Randomly shift every point cloud, as provider.shift_point_cloud
+    """
+    rigid = True
+
+    def __init__(self, shift_range=0.1):
+        self.shift_range = shift_range
+
+    def __call__(self, points, target):
+        B = points.shape[0]
+        shifts = torch.empty(B, 1, 3, device=points.device, dtype=points.dtype).uniform_(-self.shift_range, self.shift_range)
+        points[:, :, 0:3] += shifts
+        return points, target
+
+
+class RandomDropout():
+    """ Randomly drop points by replacing them with the first point of their cloud, as provider.random_point_dropout
+        The whole point (all channels) and its label are copied, so dropped points stay consistent
+    """
+    rigid = False
+
+    def __init__(self, max_dropout_ratio=0.875):
+        self.max_dropout_ratio = max_dropout_ratio
+
+    def __call__(self, points, target):
+        B, N = points.shape[0], points.shape[1]
+        dropout_ratio = torch.rand(B, 1, device=points.device) * self.max_dropout_ratio
+        drop = torch.rand(B, N, device=points.device) <= dropout_ratio
+        points[drop] = points[:, 0:1, :].expand(-1, N, -1)[drop]
+        target[drop] = target[:, 0:1].expand(-1, N)[drop]
+        return points, target
+
+
+class Compose():
+    """ Apply a list of transforms in order
+    """
+    def __init__(self, transforms):
+        self.transforms = list(transforms)
+        # Distances between points are preserved, precomputed sampling and grouping indices stay valid
+        self.rigid = all(transform.rigid for transform in self.transforms)
+
+    def __call__(self, points, target):
+        for transform in self.transforms:
+            points, target = transform(points, target)
+        return points, target
+
+
+AUGMENTATIONS = {
+    'rotate_z': RandomRotateZ,
+    'jitter': RandomJitter,
+    'scale': RandomScale,
+    'shift': RandomShift,
+    'dropout': RandomDropout,
+}
+
+
+def build_augmentation(names):
+    """ Build the augmentation pipeline from names in AUGMENTATIONS, in the given order
+        'none' or an empty list gives an empty pipeline
+    """
+    names = [name for name in names if name != 'none']
+    for name in names:
+        if name not in AUGMENTATIONS:
+            raise ValueError('Unknown augmentation %s, choose from %s' % (name, ', '.join(AUGMENTATIONS)))
+    return Compose([AUGMENTATIONS[name]() for name in names])
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import torch
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+from localfunctions import AMP_MODES, amp_autocast, amp_grad_scaler, peak_memory_mb
+
+# Compare training steps of pointnet2_sem_seg with and without mixed precision, throughput and peak memory
+# Every mode runs in its own process so that the CPU peak resident size is not shared between modes
+# python extra/benchmark_amp.py --device cpu --modes off bf16
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('AMP benchmark')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='cpu or cuda [default: cuda when available]')
+    parser.add_argument('--modes', nargs='+', default=['off', 'bf16'], choices=list(AMP_MODES), help='amp modes')
+    parser.add_argument('--batch_size', type=int, default=8, help='Batch Size [default: 8]')
+    parser.add_argument('--npoint', type=int, default=4096, help='Point Number [default: 4096]')
+    parser.add_argument('--num_extra_features', type=int, default=0, help='extra feature channels [default: 0]')
+    parser.add_argument('--steps', type=int, default=5, help='timed training steps [default: 5]')
+    parser.add_argument('--channels_last', default=False, action="store_true", help='channels-last model')
+    return parser.parse_args()
+
+
+def run_mode(args, amp, queue):
+    from models import pointnet2_sem_seg as MODEL
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    classifier = MODEL.get_model(8, args.num_extra_features).to(device).train()
+    if args.channels_last:
+        classifier = classifier.to(memory_format=torch.channels_last)
+    criterion = MODEL.get_loss().to(device)
+    optimizer = torch.optim.Adam(classifier.parameters(), lr=0.001)
+    scaler = amp_grad_scaler(device, amp)
+    points = torch.rand(args.batch_size, 6 + args.num_extra_features, args.npoint, device=device)
+    target = torch.randint(0, 8, (args.batch_size * args.npoint,), device=device)
+    weights = torch.ones(8, device=device)
+
+    def step():
+        optimizer.zero_grad()
+        with amp_autocast(device, amp):
+            seg_pred, trans_feat = classifier(points)
+            loss = criterion(seg_pred.contiguous().view(-1, 8).float(), target, trans_feat, weights)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    step() # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.time()
+    for _ in range(args.steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    seconds = time.time() - start
+    queue.put((args.steps * args.batch_size / seconds, peak_memory_mb(device)))
+
+
+def main(args):
+    context = multiprocessing.get_context('spawn')
+    print('%6s %14s %16s' % ('amp', 'samples / s', 'peak memory MB'))
+    for amp in args.modes:
+        queue = context.Queue()
+        process = context.Process(target=run_mode, args=(args, amp, queue))
+        process.start()
+        throughput, memory = queue.get()
+        process.join()
+        print('%6s %14.2f %16.0f' % (amp, throughput, memory))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
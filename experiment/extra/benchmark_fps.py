@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import argparse
+import torch
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+from models.pointnet2_utils import farthest_point_sample
+
+# Compare the farthest point sampling backends on random clouds
+# python extra/benchmark_fps.py --device cpu --batch_size 4
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('FPS benchmark')
+    parser.add_argument('--device', type=str, default='cpu', help='cpu or cuda [default: cpu]')
+    parser.add_argument('--batch_size', type=int, default=4, help='clouds per batch [default: 4]')
+    parser.add_argument('--num_points', type=int, nargs='+', default=[4096, 16384, 65536], help='points per cloud')
+    parser.add_argument('--ratio', type=int, default=4, help='npoint = N / ratio, as sa1 [default: 4]')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per backend [default: 3]')
+    parser.add_argument('--backends', nargs='+', default=['torch', 'numpy', 'approx'], help='backends to compare')
+    return parser.parse_args()
+
+
+def timed(backend, xyz, npoint, repeat):
+    farthest_point_sample(xyz, npoint, backend) # warm up
+    if xyz.device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        centroids = farthest_point_sample(xyz, npoint, backend)
+    if xyz.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat, centroids
+
+
+def coverage(xyz, centroids):
+    # Largest distance from any point to its nearest sample, lower is better
+    sampled = torch.gather(xyz, 1, centroids.unsqueeze(-1).expand(-1, -1, 3))
+    nearest = torch.cat([torch.cdist(chunk, sampled).min(-1)[0] for chunk in xyz.split(4096, dim=1)], dim=1)
+    return nearest.max(-1)[0].mean().item()
+
+
+def main(args):
+    device = torch.device(args.device)
+    print('%8s %8s %10s %12s %10s' % ('N', 'npoint', 'backend', 'time [s]', 'coverage'))
+    for N in args.num_points:
+        npoint = N // args.ratio
+        torch.manual_seed(0)
+        xyz = torch.rand(args.batch_size, N, 3, device=device)
+        for backend in args.backends:
+            seconds, centroids = timed(backend, xyz, npoint, args.repeat)
+            print('%8d %8d %10s %12.4f %10.4f' % (N, npoint, backend, seconds, coverage(xyz, centroids)))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -19,6 +19,15 @@ import matplotlib.pyplot as plt
 import time
 import open3d as o3d
 import pickle
+import itertools
+import hashlib
+import json
+import multiprocessing
+from multiprocessing import shared_memory
+from scipy.spatial import cKDTree
+
+GEO_FEATURES = ['Planarity', 'Omnivariance', 'Surface variation']
+GEO_CACHE_DIR = 'geofeature_cache' # created next to the LAS files
 
 def PCA(data, correlation=False, sort=True):
     average_data = np.mean(data, axis=0)  # 求 NX3 向量的均值
@@ -35,56 +44,145 @@ def PCA(data, correlation=False, sort=True):
     return eigenvalues, eigenvectors
 
 
-def collFeatures(pcd, length, size=0.8, num_of_files=1):
-    pcd_tree = o3d.geometry.KDTreeFlann(pcd)  # set a kd tree for tha point cloud, make searching faster
-    normals = []
-    llambda = []
-    lp = []
-    lo = []
-    lc = []
-    non_idx = []
-    # print(point_cloud_o3d)  #geometry::PointCloud with 10000 points.
-    print(length)  # 10000
-    for i in range(length):
-        # search_knn_vector_3d， input[point，x]      returns [int, open3d.utility.IntVector, open3d.utility.DoubleVector]
-        [_, idx, _] = pcd_tree.search_radius_vector_3d(pcd.points[i], size)
-        # asarray is the same as array  but asarray will save the memeory
-        k_nearest_point = np.asarray(pcd.points)[idx,
-                          :]  # find the surrounding points for each point, set them as a curve and use PCA to find the normal
-        lamb, v = PCA(k_nearest_point)
-        if len(k_nearest_point) == 1:
-            non_idx.append(i)  # record the index that has no knn point
-            p = 0
-            o = 0
-            c = 0
-        else:
-            p = (lamb[1] - lamb[2]) / lamb[0]  # calculate features based on eigenvalues
-            o = pow(lamb[0] * lamb[1] * lamb[2], 1.0 / 3.0)
-            c = lamb[2] / sum(lamb)
-        normals.append(v[:, 1])
-        llambda.append(lamb)
-        lp.append(p)
-        lo.append(o)
-        lc.append(c)
-
-    normals_array = np.array(normals) 
-    llambda_array = np.array(llambda)  # Convert the list of eigenvalues to a NumPy array
-    lp_array = np.array(lp).reshape(length, -1)  # Convert the list of lp features to a NumPy array
-    lo_array = np.array(lo).reshape(length, -1)  # Convert the list of lo features to a NumPy array
-    lc_array = np.array(lc).reshape(length, -1) 
-
-    lp_split = np.split(lp_array, num_of_files, axis=1)
-    lo_split = np.split(lo_array, num_of_files, axis=1)
-    lc_split = np.split(lc_array, num_of_files, axis=1)
-    llambda_split = np.split(llambda_array, num_of_files, axis=1)
-    normals_split = np.split(normals_array, num_of_files, axis=1)
-
-    print(lp_split)
-    print("shape of lp: ", lp_split.shape)
-    for i, column in enumerate(lp_split, start=1):
-        print(f"Column {i}:\n", column)
-        
-    return normals_array.tolist(), llambda_array.tolist(), lp_split.tolist(), lo_array.tolist(), lc_array.tolist(), non_idx
+def neighbourhoodPCA(points, size=0.8, query_idx=None, tree=None, max_pairs=4000000, workers=-1):
+    # Eigen-analysis of the radius neighbourhood of many points at once
+    # Neighbour lists come from one bulk cKDTree query per chunk, the 3x3 scatter matrices of a chunk are
+    # summed with np.add.reduceat and solved together with a batched np.linalg.eigh.
+    # Return eigenvalues (M x 3, descending), normals (M x 3, smallest eigenvector) and neighbour counts (M)
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    if tree is None:
+        tree = cKDTree(points)
+    if query_idx is None:
+        query_idx = np.arange(points.shape[0])
+    num_query = query_idx.shape[0]
+
+    eigenvalues = np.zeros((num_query, 3))
+    normals = np.zeros((num_query, 3))
+    num_neighbours = tree.query_ball_point(points[query_idx], size, workers=workers, return_length=True)
+    num_neighbours = np.asarray(num_neighbours, dtype=np.int64)
+
+    # Chunk the queries so that a chunk holds at most max_pairs (query, neighbour) pairs
+    pair_end = np.cumsum(num_neighbours)
+    start = 0
+    while start < num_query:
+        end = int(np.searchsorted(pair_end, pair_end[start] - num_neighbours[start] + max_pairs, side='right'))
+        end = max(end, start + 1)
+        query = query_idx[start:end]
+
+        neighbours = tree.query_ball_point(points[query], size, workers=workers, return_sorted=True)
+        lengths = num_neighbours[start:end]
+        flat = np.fromiter(itertools.chain.from_iterable(neighbours), dtype=np.int64, count=int(lengths.sum()))
+        offsets = np.zeros(lengths.size, dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+
+        # Scatter matrix sum((p - mean)(p - mean)^T), accumulated relative to the query point for precision
+        d = points[flat] - np.repeat(points[query], lengths, axis=0)
+        s1 = np.add.reduceat(d, offsets, axis=0)
+        s2 = np.add.reduceat(d[:, [0, 0, 0, 1, 1, 2]] * d[:, [0, 1, 2, 1, 2, 2]], offsets, axis=0)
+        H = np.empty((lengths.size, 3, 3))
+        H[:, [0, 0, 0, 1, 1, 2], [0, 1, 2, 1, 2, 2]] = s2
+        H[:, [1, 2, 2], [0, 0, 1]] = s2[:, [1, 2, 4]]
+        H -= s1[:, :, np.newaxis] * s1[:, np.newaxis, :] / lengths[:, np.newaxis, np.newaxis]
+
+        w, v = np.linalg.eigh(H)  # ascending
+        eigenvalues[start:end] = np.clip(w[:, ::-1], 0, None)
+        normals[start:end] = v[:, :, 0]
+        start = end
+
+    return eigenvalues, normals, num_neighbours
+
+
+def _chunkPCA(task):
+    # Worker of neighbourhoodPCAParallel: PCA of the core points of one x-slab, using the slab plus a halo
+    # of `size` so every neighbourhood is complete. Points and results live in shared memory.
+    points_name, out_name, num_points, x_lo, x_hi, last, size = task
+    points_shm = shared_memory.SharedMemory(name=points_name)
+    out_shm = shared_memory.SharedMemory(name=out_name)
+    try:
+        points = np.ndarray((num_points, 3), dtype=np.float64, buffer=points_shm.buf)
+        out = np.ndarray((num_points, 7), dtype=np.float64, buffer=out_shm.buf)
+
+        x = points[:, 0]
+        core = (x >= x_lo) & ((x <= x_hi) if last else (x < x_hi))
+        halo_idx = np.where((x >= x_lo - size * 1.01) & (x <= x_hi + size * 1.01))[0]
+        core_local = np.where(core[halo_idx])[0]
+        if core_local.size > 0:
+            # halo_idx is ascending, so local neighbour order is the global order and sums match the serial path
+            halo_points = points[halo_idx]
+            eigenvalues, normals, num_neighbours = neighbourhoodPCA(halo_points, size, query_idx=core_local,
+                                                                    workers=1)
+            core_idx = halo_idx[core_local]
+            out[core_idx, 0:3] = eigenvalues
+            out[core_idx, 3:6] = normals
+            out[core_idx, 6] = num_neighbours
+    finally:
+        points_shm.close()
+        out_shm.close()
+    return x_lo
+
+
+def neighbourhoodPCAParallel(points, size=0.8, num_workers=4, chunks_per_worker=4):
+    # neighbourhoodPCA over x-slabs of the room in a process pool, results are identical to the serial path
+    num_points = points.shape[0]
+    points_shm = shared_memory.SharedMemory(create=True, size=max(num_points * 3 * 8, 1))
+    out_shm = shared_memory.SharedMemory(create=True, size=max(num_points * 7 * 8, 1))
+    try:
+        shared_points = np.ndarray((num_points, 3), dtype=np.float64, buffer=points_shm.buf)
+        shared_points[:] = points[:, :3]
+        out = np.ndarray((num_points, 7), dtype=np.float64, buffer=out_shm.buf)
+
+        # Slabs with equal point counts
+        num_chunks = num_workers * chunks_per_worker
+        edges = np.quantile(shared_points[:, 0], np.linspace(0, 1, num_chunks + 1))
+        tasks = [(points_shm.name, out_shm.name, num_points, edges[i], edges[i + 1], i == num_chunks - 1, size)
+                 for i in range(num_chunks) if i == num_chunks - 1 or edges[i] < edges[i + 1]]
+        with multiprocessing.Pool(num_workers) as pool:
+            for _ in pool.imap_unordered(_chunkPCA, tasks):
+                pass
+
+        eigenvalues = out[:, 0:3].copy()
+        normals = out[:, 3:6].copy()
+        num_neighbours = out[:, 6].astype(np.int64)
+    finally:
+        points_shm.close()
+        points_shm.unlink()
+        out_shm.close()
+        out_shm.unlink()
+
+    return eigenvalues, normals, num_neighbours
+
+
+def eigenFeatures(eigenvalues, num_neighbours):
+    # Planarity, omnivariance and surface variation from descending eigenvalues
+    # Points without any neighbour but themselves get 0 and are reported in non_idx
+    l0, l1, l2 = eigenvalues[:, 0], eigenvalues[:, 1], eigenvalues[:, 2]
+    total = l0 + l1 + l2
+    valid = (num_neighbours > 1) & (l0 > 0)
+    lp = np.zeros(eigenvalues.shape[0])
+    lo = np.zeros(eigenvalues.shape[0])
+    lc = np.zeros(eigenvalues.shape[0])
+    lp[valid] = (l1[valid] - l2[valid]) / l0[valid]
+    lo[valid] = np.cbrt(l0[valid] * l1[valid] * l2[valid])
+    lc[valid] = l2[valid] / total[valid]
+    non_idx = np.where(num_neighbours <= 1)[0]
+    return lp, lo, lc, non_idx
+
+
+def collFeatures(pcd, length=None, size=0.8, num_workers=1):
+    # Geometric features of the first `length` points of the point cloud (all points by default)
+    points = np.asarray(pcd.points)
+    if length is None:
+        length = points.shape[0]
+    print(length)
+
+    if num_workers > 1:
+        llambda, normals, num_neighbours = neighbourhoodPCAParallel(points, size, num_workers)
+        llambda, normals, num_neighbours = llambda[:length], normals[:length], num_neighbours[:length]
+    else:
+        llambda, normals, num_neighbours = neighbourhoodPCA(points, size, query_idx=np.arange(length))
+    lp, lo, lc, non_idx = eigenFeatures(llambda, num_neighbours)
+
+    return normals, llambda, lp, lo, lc, non_idx
 
 
 def downsamplingPCD(pcd, dataset):
@@ -126,7 +224,7 @@ def createPCD(dataset):
 
     return pcd, all_points, all_labels
 
-def add_geofeature(dataset, dwnsample, visualize):
+def add_geofeature(dataset, dwnsample, visualize, num_workers=1):
     # Open3D
     pcd, points, labels = createPCD(dataset)
 
@@ -145,11 +243,10 @@ def add_geofeature(dataset, dwnsample, visualize):
 
     # Geometric Feature Addition
     # add features, normals, lambda, p, o, c, radius is 0.8m
-    dataset_total_len = len(dataset)
-    eigenNorm, llambda, lp, lo, lc, non_index = collFeatures(pcd, dataset_total_len)
+    eigenNorm, llambda, lp, lo, lc, non_index = collFeatures(pcd, len(points), num_workers=num_workers)
 
-    print("eigenvector len = %" % len(eigenNorm))
-    print("non-index = %" % len(non_index))
+    print("eigenvector len = %d" % len(eigenNorm))
+    print("non-index = %d" % len(non_index))
 
     # Store the additional features in the CustomDataset instance
     dataset.lp_data = lp
@@ -163,29 +260,119 @@ def add_geofeature(dataset, dwnsample, visualize):
         dataset.filtered_update(filtered_indices)
 
 
-def cal_geofeature(dataset, dwnsample, visualize):
-    # Open3D
-    pcd, points, labels = createPCD(dataset)
-
-    # Downsampling
+def roomGeofeatures(points, size=0.8, num_workers=1):
+    # Planarity, omnivariance and surface variation of every point of one room
+    if num_workers > 1:
+        llambda, normals, num_neighbours = neighbourhoodPCAParallel(points, size, num_workers)
+    else:
+        llambda, normals, num_neighbours = neighbourhoodPCA(points, size)
+    return eigenFeatures(llambda, num_neighbours)
+
+
+def fileHash(file_path, block_size=1 << 20):
+    # SHA-1 of the file content, so renamed or copied files still hit the cache
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def featureCacheDir(file_path, size, voxel=0.0, features=GEO_FEATURES):
+    # Cache directory of one LAS file, keyed by (content hash, radius, downsample voxel, feature set)
+    key_fields = {'file_hash': fileHash(file_path), 'radius': float(size), 'voxel': float(voxel),
+                  'features': list(features)}
+    key = hashlib.sha1(json.dumps(key_fields, sort_keys=True).encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(os.path.dirname(os.path.abspath(file_path)), GEO_CACHE_DIR, stem + '_' + key), key_fields
+
+
+def loadFeatureCache(cache_dir, num_points):
+    # Memory-mapped float32 feature columns, None if the cache is missing or does not match the room
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest['num_points'] != num_points:
+        return None
+
+    columns = [np.load(os.path.join(cache_dir, name), mmap_mode='r') for name in manifest['columns']]
+    non_idx = np.load(os.path.join(cache_dir, 'non_index.npy'))
+    return columns + [non_idx]
+
+
+def saveFeatureCache(cache_dir, key_fields, lp, lo, lc, non_idx):
+    # Write into a temporary directory first so a killed run never leaves a half-written cache
+    names = [feature.lower().replace(' ', '_') + '.npy' for feature in GEO_FEATURES]
+    tmp_dir = cache_dir + '.tmp%d' % os.getpid()
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, column in zip(names, [lp, lo, lc]):
+            np.save(os.path.join(tmp_dir, name), np.asarray(column, dtype=np.float32))
+        np.save(os.path.join(tmp_dir, 'non_index.npy'), np.asarray(non_idx, dtype=np.int64))
+        manifest = dict(key_fields, num_points=int(len(lp)), columns=names)
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_dir, cache_dir)
+    except OSError as e:
+        print("Could not write geometric feature cache %s: %s" % (cache_dir, e))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def cal_geofeature(dataset, dwnsample, visualize, num_workers=1, size=0.8, use_cache=True):
+    # Downsampling merges every room into one cloud, that path is computed as a whole and not cached
     if dwnsample is True:
+        pcd, points, labels = createPCD(dataset)
         pcd, points, labels, dataset = downsamplingPCD(pcd, dataset)
         print("downsampled room_idx")
         print(len(dataset))
+        eigenNorm, llambda, lp, lo, lc, non_index = collFeatures(pcd, len(points), size, num_workers)
+        print("eigenvector len = %d" % len(eigenNorm))
+        print("non-index = %d" % len(non_index))
+        return lp, lo, lc, non_index
 
     # Visualization
     if  visualize is True:
+        pcd, points, labels = createPCD(dataset)
         colors = plt.get_cmap("tab20")(np.array(labels).reshape(-1) / 17.0)
         colors = colors[:, 0:3]
         pcd.colors = o3d.utility.Vector3dVector(colors)
         o3d.visualization.draw_geometries([pcd], window_name='test the color', width=800, height=600)
 
-    # Geometric Feature Addition
-    # add features, normals, lambda, p, o, c, radius is 0.8m
-    dataset_total_len = len(dataset)
-    eigenNorm, llambda, lp, lo, lc, non_index = collFeatures(pcd, dataset_total_len)
-
-    print("eigenvector len = %" % len(eigenNorm))
-    print("non-index = %" % len(non_index))
+    # Geometric Feature Addition, room by room so every LAS file has its own cache entry
+    # add features p, o, c, radius is 0.8m
+    room_points = dataset.room_points if hasattr(dataset, 'room_points') else dataset.scene_points_list
+    room_files = getattr(dataset, 'room_files', [])
+    if len(room_files) != len(room_points):
+        room_files = [None] * len(room_points)
+
+    lp_rooms, lo_rooms, lc_rooms, non_rooms = [], [], [], []
+    offset = 0
+    for points, file_path in zip(room_points, room_files):
+        cached = None
+        if use_cache is True and file_path is not None:
+            cache_dir, key_fields = featureCacheDir(file_path, size)
+            cached = loadFeatureCache(cache_dir, len(points))
+
+        if cached is None:
+            lp, lo, lc, non_idx = roomGeofeatures(points, size, num_workers)
+            lp, lo, lc = lp.astype(np.float32), lo.astype(np.float32), lc.astype(np.float32)
+            if use_cache is True and file_path is not None:
+                saveFeatureCache(cache_dir, key_fields, lp, lo, lc, non_idx)
+        else:
+            print("Geometric features loaded from " + cache_dir)
+            lp, lo, lc, non_idx = cached
+
+        lp_rooms.append(lp)
+        lo_rooms.append(lo)
+        lc_rooms.append(lc)
+        non_rooms.append(np.asarray(non_idx) + offset)
+        offset += len(points)
+
+    lp, lo, lc = np.concatenate(lp_rooms), np.concatenate(lo_rooms), np.concatenate(lc_rooms)
+    non_index = np.concatenate(non_rooms) if non_rooms else np.array([], dtype=np.int64)
+    print("geometric feature len = %d" % len(lp))
+    print("non-index = %d" % len(non_index))
 
     return lp, lo, lc, non_index
@@ -2,6 +2,9 @@ import os
 import torch
 import datetime
 import provider
+from augmentation import build_augmentation
+from metrics import ConfusionMatrix
+from predictions import PredictionWriter, vote_confidence
 import numpy as np
 from tqdm import tqdm
 import laspy
@@ -15,10 +18,17 @@ import logging
 import sys
 import importlib
 import shutil
+import json
 import glob
+import queue
+import threading
+import contextlib
 from collections import Counter
+from scipy.spatial import cKDTree
 from datetime import datetime
 from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data.dataloader import default_collate
+from models.pointnet2_utils import GeometryContext
 from pathlib import Path
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -129,7 +139,509 @@ def CurrentTime(timezone):
 
 
 
+'''Spatial indexing'''
+class GridIndex2D():
+    # Bucket the XY coordinates of a room into square cells once, so a block query only
+    # touches the points of the cells it overlaps instead of scanning the whole room
+    def __init__(self, points, cell_size):
+        self.cell_size = float(cell_size)
+        self.origin = np.amin(points[:, :2], axis=0)
+        cells = np.floor((points[:, :2] - self.origin) / self.cell_size).astype(np.int64)
+        self.nx, self.ny = int(cells[:, 0].max()) + 1, int(cells[:, 1].max()) + 1
+        cell_id = cells[:, 1] * self.nx + cells[:, 0]  # row-major, a row of cells is contiguous
+
+        # Point indices grouped by cell (CSR layout), ascending point index inside each cell
+        self.order = np.argsort(cell_id, kind='stable')
+        counts = np.bincount(cell_id, minlength=self.nx * self.ny)
+        self.cell_start = np.zeros(counts.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.cell_start[1:])
+
+        # Summed-area table, integral[iy, ix] = number of points in cells [0:iy, 0:ix]
+        self.integral = np.zeros((self.ny + 1, self.nx + 1), dtype=np.int64)
+        self.integral[1:, 1:] = counts.reshape(self.ny, self.nx).cumsum(axis=0).cumsum(axis=1)
+
+    def cell_range(self, lo, hi, axis):
+        # Cells along one axis that may hold points within [lo, hi], clipped to the grid
+        n = self.nx if axis == 0 else self.ny
+        tol = 1e-6 * self.cell_size
+        k0 = np.floor((lo - tol - self.origin[axis]) / self.cell_size).astype(np.int64)
+        k1 = np.floor((hi + tol - self.origin[axis]) / self.cell_size).astype(np.int64)
+        return np.clip(k0, 0, n - 1), np.clip(k1, -1, n - 1)
+
+    def inner_cell_range(self, lo, hi, axis):
+        # Cells along one axis lying completely inside [lo, hi]
+        n = self.nx if axis == 0 else self.ny
+        tol = 1e-6 * self.cell_size
+        k0 = np.ceil((lo + tol - self.origin[axis]) / self.cell_size).astype(np.int64)
+        k1 = np.floor((hi - tol - self.origin[axis]) / self.cell_size).astype(np.int64) - 1
+        return np.clip(k0, 0, n), np.clip(k1, -1, n - 1)
+
+    def rect_count(self, kx0, kx1, ky0, ky1):
+        # Number of points in the cell rectangles [kx0..kx1] x [ky0..ky1], vectorized
+        empty = (kx1 < kx0) | (ky1 < ky0)
+        kx0, ky0 = np.minimum(kx0, self.nx), np.minimum(ky0, self.ny)
+        kx1, ky1 = np.maximum(kx1, kx0 - 1), np.maximum(ky1, ky0 - 1)
+        total = (self.integral[ky1 + 1, kx1 + 1] - self.integral[ky0, kx1 + 1]
+                 - self.integral[ky1 + 1, kx0] + self.integral[ky0, kx0])
+        return np.where(empty, 0, total)
+
+    def count_bounds(self, block_min, block_max):
+        # Lower/upper bound on the number of points inside each [block_min, block_max] XY box
+        # block_min, block_max: M x 2 arrays
+        ix0, ix1 = self.inner_cell_range(block_min[:, 0], block_max[:, 0], 0)
+        iy0, iy1 = self.inner_cell_range(block_min[:, 1], block_max[:, 1], 1)
+        ox0, ox1 = self.cell_range(block_min[:, 0], block_max[:, 0], 0)
+        oy0, oy1 = self.cell_range(block_min[:, 1], block_max[:, 1], 1)
+        return self.rect_count(ix0, ix1, iy0, iy1), self.rect_count(ox0, ox1, oy0, oy1)
+
+    def query(self, points, block_min, block_max):
+        # Indices of the points inside [block_min, block_max] (XY, inclusive), in ascending order
+        # so the result matches np.where over the whole room
+        kx0, kx1 = self.cell_range(block_min[0], block_max[0], 0)
+        ky0, ky1 = self.cell_range(block_min[1], block_max[1], 1)
+        if kx1 < kx0 or ky1 < ky0:
+            return np.array([], dtype=np.int64)
+
+        rows = [self.order[self.cell_start[iy * self.nx + kx0]:self.cell_start[iy * self.nx + kx1 + 1]]
+                for iy in range(ky0, ky1 + 1)]
+        candidates = np.concatenate(rows)
+        xy = points[candidates, :2]
+        inside = ((xy[:, 0] >= block_min[0]) & (xy[:, 0] <= block_max[0]) &
+                  (xy[:, 1] >= block_min[1]) & (xy[:, 1] <= block_max[1]))
+        return np.sort(candidates[inside])
+
+
+def valid_block_centres(points, grid, block_size, min_points=1024):
+    # Indices of the points whose block_size x block_size XY block holds more than min_points points.
+    # Drawing a centre uniformly from these gives the same distribution as redrawing random points
+    # until the block is large enough.
+    half = np.array([block_size / 2.0, block_size / 2.0])
+    block_min = points[:, :2] - half
+    block_max = points[:, :2] + half
+    lower, upper = grid.count_bounds(block_min, block_max)
+    valid = lower > min_points
+
+    # Only the blocks whose bounds straddle the threshold need an exact count, one bulk Chebyshev ball
+    # count over a KD-tree of the room (near the threshold that can be almost every point)
+    undecided = np.where((lower <= min_points) & (upper > min_points))[0]
+    if undecided.size > 0:
+        tree = cKDTree(points[:, :2])
+        counts = tree.query_ball_point(points[undecided, :2], block_size / 2.0, p=np.inf,
+                                       return_length=True, workers=-1)
+        valid[undecided] = counts > min_points
+
+    return np.where(valid)[0]
+
+
+'''Label remapping'''
+# TUM-Facade 18 classes merged into 8
+# 0: wall (+ drainpipe, stairs, outer ceiling surface), 1: window (+ blinds), 2: door, 3: molding (+ deco),
+# 4: other (+ roof, interior), 5: terrain (+ ground surface), 6: column, 7: arch
+CLASS8_MAPPING = {1: 0, 9: 0, 10: 0, 15: 0, 2: 1, 14: 1, 3: 2, 5: 3, 6: 3, 13: 4, 16: 4, 17: 4, 11: 5, 12: 5,
+                  7: 6, 8: 7}
+IGNORE_LABEL = 255
+
+
+class LabelRemap():
+    # Remap classification labels with one uint8 lookup table gather, lut[labels]
+    # Labels missing from the mapping become IGNORE_LABEL, which the loss and the metrics skip
+    def __init__(self, mapping, classes=None):
+        self.lut = np.full(256, IGNORE_LABEL, dtype=np.uint8)
+        for source, target in mapping.items():
+            if not 0 <= int(target) < IGNORE_LABEL:
+                raise ValueError('Target class %s of label %s is outside [0, %d)' % (target, source, IGNORE_LABEL))
+            self.lut[int(source)] = target
+        self.num_classes = max(int(target) for target in mapping.values()) + 1 if len(mapping) > 0 else 0
+        if classes is not None and len(classes) < self.num_classes:
+            raise ValueError('%d class names for %d classes' % (len(classes), self.num_classes))
+        self.classes = classes
+
+    def __call__(self, labels):
+        return self.lut[labels]
+
+    @staticmethod
+    def from_file(file_path):
+        # JSON file: {"classes": ["wall", ...], "mapping": {"1": 0, "9": 0, ...}}, classes is optional
+        with open(file_path) as f:
+            config = json.load(f)
+        return LabelRemap(config['mapping'], config.get('classes'))
+
+
+'''Reading'''
+COLOR_FEATURES = ('red', 'green', 'blue')
+
+# Storage dtypes shared by both datasets. Coordinates are local to a float64 origin per room,
+# float64 local coordinates are only needed for very large rooms.
+COORD_DTYPES = {'float32': np.float32, 'float64': np.float64}
+FEATURE_DTYPE = np.float32
+LABEL_DTYPE = np.uint8
+
+
+def normalize_features(features, feature_name):
+    # Scale colour columns of a room feature matrix (N x F) to [0, 1] once, in place
+    for ix, name in enumerate(feature_name):
+        if name in COLOR_FEATURES:
+            features[:, ix] /= 255
+    return features
+
+
+def read_las_chunked(file_path, feature_list=[], label_map=None, chunk_size=1000000, coord_dtype=np.float32):
+    # Stream a LAS/LAZ file into preallocated arrays, so peak memory is the stores plus one chunk
+    # instead of the whole decoded file plus stacked float64 copies.
+    # Coordinates are stored relative to the header minimum (origin, float64), which keeps sub-millimetre
+    # precision in float32 even for georeferenced files.
+    # label_map: optional function applied to the classification of every chunk
+    # Return coords (N x 3, coord_dtype), labels (N, uint8), features (N x F float32, colours scaled to [0, 1])
+    # and origin (3)
+    with laspy.open(file_path) as reader:
+        num_points = reader.header.point_count
+        origin = np.array(reader.header.mins, dtype=np.float64)
+        coords = np.empty((num_points, 3), dtype=coord_dtype)
+        labels = np.empty(num_points, dtype=LABEL_DTYPE)
+        features = np.empty((num_points, len(feature_list)), dtype=FEATURE_DTYPE)
+
+        start = 0
+        for chunk in reader.chunk_iterator(chunk_size):
+            end = start + len(chunk)
+            coords[start:end, 0] = chunk.x - origin[0]
+            coords[start:end, 1] = chunk.y - origin[1]
+            coords[start:end, 2] = chunk.z - origin[2]
+            classification = np.asarray(chunk.classification)
+            labels[start:end] = classification if label_map is None else label_map(classification)
+            for ix, feature in enumerate(feature_list):
+                features[start:end, ix] = getattr(chunk, feature)
+            start = end
+
+    return coords[:start], labels[:start], normalize_features(features[:start], feature_list), origin
+
+
+def append_feature_columns(room_features, columns, room_sizes):
+    # Append per-point columns computed over all rooms concatenated (e.g. geometric features)
+    # to every room feature matrix, return the new list of N x (F + len(columns)) float32 matrices
+    offsets = np.concatenate([[0], np.cumsum(room_sizes)])
+    updated = []
+    for r, size in enumerate(room_sizes):
+        new_columns = np.stack([column[offsets[r]:offsets[r + 1]] for column in columns], axis=1).astype(np.float32)
+        if r < len(room_features):
+            updated.append(np.concatenate([room_features[r], new_columns], axis=1))
+        else:
+            updated.append(new_columns)
+    return updated
+
+
+def gather_sample(points, features, idx, offset, scale, out):
+    # Write the sample of points idx into out (M x 6 + F, float32) with the fewest temporaries:
+    # columns 0:3 local coordinates, 3:6 coordinates normalised by scale after adding offset,
+    # 6: extra features. Centring of columns 0:2 is left to the caller.
+    np.take(points, idx, axis=0, out=out[:, 0:3])
+    np.multiply(out[:, 0:3], scale, out=out[:, 3:6])
+    out[:, 3:6] += offset
+    if features is not None and features.shape[1] > 0:
+        np.take(features, idx, axis=0, out=out[:, 6:])
+    return out
+
+
+'''Dataset storage'''
+def save_columnar(dir_path, attributes, arrays):
+    # Save a dataset as one .npy file per attribute plus a small JSON manifest
+    # attributes: JSON serialisable values, arrays: name -> list of per-room arrays, concatenated on disk
+    # Everything is written into a sibling temporary directory that replaces dir_path at the end, so an
+    # interrupted save never looks complete and files memory-mapped from an earlier save are not rewritten
+    dir_path = os.path.normpath(dir_path)
+    tmp_path = '%s.tmp-%d' % (dir_path, os.getpid())
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    manifest = {'format': 'columnar', 'attributes': attributes, 'arrays': {}}
+    for name, rooms in arrays.items():
+        rooms = [np.asarray(room) for room in rooms]
+        lengths = [int(room.shape[0]) for room in rooms]
+        data = np.concatenate(rooms) if len(rooms) > 0 else np.zeros(0)
+        np.save(os.path.join(tmp_path, name + '.npy'), data)
+        manifest['arrays'][name] = lengths
+
+    # Manifest last, a directory without one is an unfinished save
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    # Swap the finished save in, open memory maps of the old files stay valid after they are unlinked
+    old_path = None
+    if os.path.exists(dir_path):
+        old_path = '%s.old-%d' % (dir_path, os.getpid())
+        os.replace(dir_path, old_path)
+    os.replace(tmp_path, dir_path)
+    if old_path is not None:
+        if os.path.isdir(old_path):
+            shutil.rmtree(old_path)
+        else:
+            os.remove(old_path)
+
+
+def load_columnar(dir_path):
+    # Open a dataset saved by save_columnar, arrays are memory-mapped read-only views split per room,
+    # so loading is instant and DataLoader workers share the pages instead of copying them
+    with open(os.path.join(dir_path, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    arrays = {}
+    for name, lengths in manifest['arrays'].items():
+        data = np.load(os.path.join(dir_path, name + '.npy'), mmap_mode='r')
+        arrays[name] = np.split(data, np.cumsum(lengths)[:-1]) if len(lengths) > 0 else []
+    return manifest['attributes'], arrays
+
+
+def is_columnar(path):
+    return os.path.isfile(os.path.join(path, 'manifest.json'))
+
+
+def legacy_pickle_path(path):
+    # Pickled datasets of older versions were saved as <name>.pkl
+    return path if os.path.isfile(path) else path + '.pkl'
+
+
+'''Sliding window tiling'''
+def window_edges(lo, hi, grid, block_size, stride):
+    # Start and end of every window along one axis, the last windows are pulled back inside the room
+    s = lo + np.arange(grid) * stride
+    e = np.minimum(s + block_size, hi)
+    s = e - block_size
+    return s, e
+
+
+def sliding_window_membership(points, block_size=1.0, stride=0.5, padding=0.001):
+    # Assign every point to all windows containing it in one pass over the room, instead of one
+    # full-room np.where per window. Windows are ordered row-major (y then x) and the points inside
+    # a window by ascending index, the same as the former per-window loop.
+    # Return:
+    #   window_points: point indices grouped by non-empty window
+    #   window_start:  offsets of every non-empty window in window_points, K + 1
+    #   window_centre: XY centre of every non-empty window, K x 2
+    coord_min, coord_max = np.amin(points, axis=0)[:3], np.amax(points, axis=0)[:3]
+    grid_x = int(np.ceil(float(coord_max[0] - coord_min[0] - block_size) / stride) + 1)
+    grid_y = int(np.ceil(float(coord_max[1] - coord_min[1] - block_size) / stride) + 1)
+    if grid_x <= 0 or grid_y <= 0:
+        return np.array([], dtype=np.int64), np.zeros(1, dtype=np.int64), np.zeros((0, 2))
+
+    s_x, e_x = window_edges(coord_min[0], coord_max[0], grid_x, block_size, stride)
+    s_y, e_y = window_edges(coord_min[1], coord_max[1], grid_y, block_size, stride)
+
+    # Window starts and ends are non-decreasing, so the windows holding a point form a contiguous range per axis
+    lo_x = np.searchsorted(e_x + padding, points[:, 0], side='left')
+    hi_x = np.searchsorted(s_x - padding, points[:, 0], side='right') - 1
+    lo_y = np.searchsorted(e_y + padding, points[:, 1], side='left')
+    hi_y = np.searchsorted(s_y - padding, points[:, 1], side='right') - 1
+    span_x = int(max((hi_x - lo_x).max(initial=-1) + 1, 0))
+    span_y = int(max((hi_y - lo_y).max(initial=-1) + 1, 0))
+
+    window_ids, point_ids = [], []
+    for dy in range(span_y):
+        for dx in range(span_x):
+            member = np.where((lo_x + dx <= hi_x) & (lo_y + dy <= hi_y))[0]
+            window_ids.append((lo_y[member] + dy) * grid_x + lo_x[member] + dx)
+            point_ids.append(member)
+    window_ids = np.concatenate(window_ids) if window_ids else np.array([], dtype=np.int64)
+    point_ids = np.concatenate(point_ids) if point_ids else np.array([], dtype=np.int64)
+
+    order = np.lexsort((point_ids, window_ids))
+    window_points = point_ids[order]
+    counts = np.bincount(window_ids, minlength=grid_x * grid_y)
+    occupied = np.where(counts > 0)[0]
+    window_start = np.zeros(occupied.size + 1, dtype=np.int64)
+    np.cumsum(counts[occupied], out=window_start[1:])
+
+    index_y, index_x = occupied // grid_x, occupied % grid_x
+    window_centre = np.stack((s_x[index_x] + block_size / 2.0, s_y[index_y] + block_size / 2.0), axis=1)
+
+    return window_points, window_start, window_centre
+
+
+def sliding_window_blocks(window_start, block_points):
+    # Pad every window up to a multiple of block_points with randomly repeated members and shuffle it,
+    # as np.random.choice + np.random.shuffle did per window, for all windows at once.
+    # Return:
+    #   positions:   indices into window_points, num_blocks * block_points
+    #   slot_window: window of every returned position
+    counts = np.diff(window_start)
+    num_windows = counts.size
+    sizes = ((counts + block_points - 1) // block_points) * block_points
+    fill = sizes - counts
+    slot_start = np.zeros(num_windows + 1, dtype=np.int64)
+    np.cumsum(sizes, out=slot_start[1:])
+    positions = np.empty(slot_start[-1], dtype=np.int64)
+
+    # Every member once
+    member_window = np.repeat(np.arange(num_windows), counts)
+    member_rank = np.arange(member_window.size) - window_start[member_window]
+    positions[slot_start[member_window] + member_rank] = np.arange(member_window.size)
+
+    # Fill without replacement when the window holds enough points: the first members of a random order
+    random_order = np.lexsort((np.random.random(member_window.size), member_window))
+    take = (member_rank < fill[member_window]) & (fill[member_window] <= counts[member_window])
+    taken_window = member_window[take]
+    positions[slot_start[taken_window] + counts[taken_window] + member_rank[take]] = random_order[take]
+
+    # Fill with replacement otherwise
+    replace = np.where(fill > counts)[0]
+    fill_window = np.repeat(replace, fill[replace])
+    fill_rank = np.arange(fill_window.size) - np.repeat(np.cumsum(fill[replace]) - fill[replace], fill[replace])
+    positions[slot_start[fill_window] + counts[fill_window] + fill_rank] = \
+        window_start[fill_window] + np.random.randint(0, counts[fill_window])
+
+    # Shuffle inside every window
+    slot_window = np.repeat(np.arange(num_windows), sizes)
+    shuffle = np.lexsort((np.random.random(slot_window.size), slot_window))
+    return positions[shuffle], slot_window
+
+
+
 '''Training'''
+class GeometryCollate():
+    # collate_fn computing the sampling/grouping/interpolation indices of every network level in the
+    # DataLoader workers, on CPU and in parallel with the forward pass of the previous batch.
+    # The indices only stay valid under rigid augmentation (rotation around z, shift).
+    # levels: (npoint, radius, nsample) per set abstraction level, see get_model.geometry_levels
+    def __init__(self, levels):
+        self.levels = levels
+
+    def __call__(self, batch):
+        points, target = default_collate(batch)
+        with torch.no_grad():
+            geometry = GeometryContext.build(points[:, :, 0:3], self.levels)
+        return points, target, geometry
+
+
+def split_batch(batch):
+    # (points, target) or (points, target, geometry) from GeometryCollate
+    return batch[0], batch[1], batch[2] if len(batch) > 2 else None
+
+
+class DevicePrefetcher():
+    # Iterate a DataLoader from a background thread with up to depth batches in flight on the device.
+    # Every batch is pinned, copied on a side CUDA stream, passed through transform(points, target)
+    # (the batched augmentation) and transposed into the BxCxN model layout, so the step loop only
+    # waits for the copy event of a batch that is already prepared. depth 0 prepares batches inline.
+    # Yields points, target (long) and geometry (None without GeometryCollate)
+    def __init__(self, loader, device, depth=2, transform=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _prepare(self, batch, stream):
+        points, target, geometry = split_batch(batch)
+        if stream is not None and not points.is_pinned():
+            points, target = points.pin_memory(), target.pin_memory()
+        if stream is not None and geometry is not None and not geometry.xyz[0].is_pinned():
+            geometry = geometry.pin_memory()
+        with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+            points = points.to(self.device, non_blocking=True)
+            target = target.to(self.device, non_blocking=True).long()
+            if self.transform is not None:
+                points, target = self.transform(points, target)
+            points = points.transpose(2, 1)
+            if geometry is not None:
+                geometry = geometry.to(self.device, non_blocking=True)
+            event = None
+            if stream is not None:
+                event = torch.cuda.Event()
+                event.record(stream)
+        return points, target, geometry, event
+
+    @staticmethod
+    def _put(batches, stop, item):
+        # Blocking put that gives up once the consumer has stopped iterating
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker(self, batches, stop):
+        stream = None
+        if self.device.type == 'cuda':
+            torch.cuda.set_device(self.device)
+            stream = torch.cuda.Stream(self.device)
+        try:
+            for batch in self.loader:
+                if not self._put(batches, stop, self._prepare(batch, stream)):
+                    return
+        except Exception as error:
+            self._put(batches, stop, error)
+            return
+        self._put(batches, stop, None)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for batch in self.loader:
+                points, target, geometry, _ = self._prepare(batch, None)
+                yield points, target, geometry
+            return
+
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._worker, args=(batches, stop), daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                points, target, geometry, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    # Memory allocated on the side stream must not be reused before the step is done with it
+                    points.record_stream(current)
+                    target.record_stream(current)
+                    if geometry is not None:
+                        geometry.record_stream(current)
+                yield points, target, geometry
+        finally:
+            stop.set()
+            worker.join()
+
+
+def select_device(name='auto', num_threads=0):
+    # torch.device from --device, 'auto' picks the GPU when there is one
+    # num_threads > 0 sets the intra-op threads used on CPU
+    if name == 'auto':
+        name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(name)
+    if device.type == 'cpu' and num_threads > 0:
+        torch.set_num_threads(num_threads)
+    return device
+
+
+# Mixed precision modes of --amp, bf16 also works with CPU autocast
+AMP_MODES = {'off': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def amp_autocast(device, amp='off'):
+    dtype = AMP_MODES[amp]
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+
+def amp_grad_scaler(device, amp='off'):
+    # Loss scaling is only needed for fp16 gradients on the GPU
+    device_type = torch.device(device).type
+    return torch.amp.GradScaler(device_type, enabled=(amp == 'fp16' and device_type == 'cuda'))
+
+
+def peak_memory_mb(device):
+    # Peak allocated GPU memory, or the peak resident size of the process on CPU
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
 def read_las_file_with_labels(file_path):
     las_data = laspy.read(file_path)
     coords = np.vstack((las_data.x, las_data.y, las_data.z)).transpose()
@@ -169,7 +681,7 @@ def compute_class_weights(las_dataset):
 # Training
 def modelTraining(start_epoch, endepoch, alearning_rate, alr_decay, astep_size, BATCH_SIZE, NUM_POINT, NUM_CLASSES,
                   trainDataLoader, testDataLoader, classifier, optimizer, criterion, train_weights, checkpoints_dir,
-                  model_name, seg_label_to_cat, logger):
+                  model_name, seg_label_to_cat, logger, augment=None, amp='off', prefetch=2):
 
     #Log and print string
     def log_string(str):
@@ -187,6 +699,16 @@ def modelTraining(start_epoch, endepoch, alearning_rate, alr_decay, astep_size,
     global_epoch = 0
     best_iou = 0
 
+    # Batched augmentation on the device, rotation around the up axis as before by default
+    if augment is None:
+        augment = build_augmentation(['rotate_z'])
+
+    model_device = next(classifier.parameters()).device
+    scaler = amp_grad_scaler(model_device, amp)
+    # Batches are moved, augmented and transposed ahead of the step in a background thread
+    trainBatches = DevicePrefetcher(trainDataLoader, model_device, prefetch, augment)
+    testBatches = DevicePrefetcher(testDataLoader, model_device, prefetch)
+
     def bn_momentum_adjust(m, momentum):
         if isinstance(m, torch.nn.BatchNorm2d) or isinstance(m, torch.nn.BatchNorm1d):
             m.momentum = momentum
@@ -205,37 +727,38 @@ def modelTraining(start_epoch, endepoch, alearning_rate, alr_decay, astep_size,
         print('BN momentum updated to: %f' % momentum)
         classifier = classifier.apply(lambda x: bn_momentum_adjust(x, momentum))
         num_batches = len(trainDataLoader)
-        total_correct = 0
-        total_seen = 0
-        loss_sum = 0
+        confusion = ConfusionMatrix(NUM_CLASSES, model_device)
+        loss_sum = torch.zeros((), device=model_device)
         classifier = classifier.train()
+        if model_device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(model_device)
+        epoch_time = time.time()
 
-        for i, (points, target) in tqdm(enumerate(trainDataLoader), total=len(trainDataLoader), smoothing=0.9):
+        for i, (points, target, geometry) in tqdm(enumerate(trainBatches), total=len(trainBatches), smoothing=0.9):
             optimizer.zero_grad()
 
-            points = points.data.numpy()
-            points[:, :, :3] = provider.rotate_point_cloud_z(points[:, :, :3])
-            points = torch.Tensor(points)
-            points, target = points.float().cuda(), target.long().cuda()
-            points = points.transpose(2, 1)
-
-            seg_pred, trans_feat = classifier(points)
-            seg_pred = seg_pred.contiguous().view(-1, NUM_CLASSES)
-
-            batch_label = target.view(-1, 1)[:, 0].cpu().data.numpy()
-            target = target.view(-1, 1)[:, 0]
-            loss = criterion(seg_pred, target, trans_feat, train_weights)
-            loss.backward()
-            optimizer.step()
-
-            pred_choice = seg_pred.cpu().data.max(1)[1].numpy()
-            correct = np.sum(pred_choice == batch_label)
-            total_correct += correct
-            total_seen += (BATCH_SIZE * NUM_POINT)
-            loss_sum += loss
+            with amp_autocast(points.device, amp):
+                if geometry is not None and getattr(augment, 'rigid', False):
+                    seg_pred, trans_feat = classifier(points, geometry)
+                else:
+                    seg_pred, trans_feat = classifier(points)
+                seg_pred = seg_pred.contiguous().view(-1, NUM_CLASSES).float()
+                target = target.view(-1, 1)[:, 0]
+                loss = criterion(seg_pred, target, trans_feat, train_weights)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+            confusion.update(seg_pred.detach().argmax(1), target)
+            loss_sum += loss.detach()
+        # Single host copy of the epoch metrics
+        loss_sum = loss_sum.item()
+        epoch_time = time.time() - epoch_time
         print("loss value = %f" % loss_sum)
         log_string('Training mean loss: %f' % (loss_sum / num_batches))
-        log_string('Training accuracy: %f' % (total_correct / float(total_seen)))
+        log_string('Training accuracy: %f' % confusion.overall_accuracy())
+        log_string('Training throughput (amp %s): %.1f samples/s, peak memory %.0f MB' %
+                   (amp, num_batches * BATCH_SIZE / max(epoch_time, 1e-9), peak_memory_mb(model_device)))
 
         if epoch % 5 == 0:
             logger.info('Save model...')
@@ -251,71 +774,47 @@ def modelTraining(start_epoch, endepoch, alearning_rate, alr_decay, astep_size,
 
 
         '''Evaluate on chopped scenes'''
-        with torch.no_grad():
+        with torch.inference_mode():
             num_batches = len(testDataLoader)
-            total_correct = 0
-            total_seen = 0
-            loss_sum = 0
-            labelweights = np.zeros(NUM_CLASSES)
-            total_seen_class = [0 for _ in range(NUM_CLASSES)]
-            total_correct_class = [0 for _ in range(NUM_CLASSES)]
-            total_iou_deno_class = [0 for _ in range(NUM_CLASSES)]
+            confusion = ConfusionMatrix(NUM_CLASSES, model_device)
+            loss_sum = torch.zeros((), device=model_device)
             classifier = classifier.eval()
 
             log_string('---- EPOCH %03d EVALUATION ----' % (global_epoch + 1))
             CurrentTime(tz)
-            for i, (points, target) in tqdm(enumerate(testDataLoader), total=len(testDataLoader), smoothing=0.9):
-                points = points.data.numpy()
-                points = torch.Tensor(points)
+            for i, (points, target, geometry) in tqdm(enumerate(testBatches), total=len(testBatches), smoothing=0.9):
                 # print("Batch shape:", points.shape)  # Debug
-                points, target = points.float().cuda(), target.long().cuda()
-                points = points.transpose(2, 1)
-
-                seg_pred, trans_feat = classifier(points)
-                pred_val = seg_pred.contiguous().cpu().data.numpy()
-                seg_pred = seg_pred.contiguous().view(-1, NUM_CLASSES)
-
-                batch_label = target.cpu().data.numpy()
+                with amp_autocast(points.device, amp):
+                    if geometry is not None:
+                        seg_pred, trans_feat = classifier(points, geometry)
+                    else:
+                        seg_pred, trans_feat = classifier(points)
+                seg_pred = seg_pred.float().contiguous().view(-1, NUM_CLASSES)
                 target = target.view(-1, 1)[:, 0]
                 loss = criterion(seg_pred, target, trans_feat, train_weights)
                 loss_sum += loss
-                pred_val = np.argmax(pred_val, 2)
-                correct = np.sum((pred_val == batch_label))
-                total_correct += correct
-                total_seen += (BATCH_SIZE * NUM_POINT)
-                tmp, _ = np.histogram(batch_label, range(NUM_CLASSES + 1))
-                labelweights += tmp
-
-                for l in range(NUM_CLASSES):
-                    total_seen_class[l] += np.sum((batch_label == l))
-                    total_correct_class[l] += np.sum((pred_val == l) & (batch_label == l))
-                    total_iou_deno_class[l] += np.sum(((pred_val == l) | (batch_label == l)))
-
-            labelweights = labelweights.astype(np.float32) / np.sum(labelweights.astype(np.float32))
-            mIoU = np.mean(np.array(total_correct_class) / (np.array(total_iou_deno_class, dtype=float) + 1e-6))
+                confusion.update(seg_pred.argmax(1), target)
+
+            # Single host copy of the matrix, all metrics are derived from it
+            loss_sum = loss_sum.item()
+            labelweights = confusion.label_weights()
+            mIoU = confusion.mean_iou()
+            accuracy = confusion.overall_accuracy()
             log_string('eval mean loss: %f' % (loss_sum / float(num_batches)))
             log_string('eval point avg class IoU: %f' % (mIoU))
-            log_string('eval point accuracy: %f' % (total_correct / float(total_seen)))
-            log_string('eval point avg class acc: %f' % (
-                np.mean(np.array(total_correct_class) / (np.array(total_seen_class, dtype=float) + 1e-6))))
+            log_string('eval point accuracy: %f' % accuracy)
+            log_string('eval point avg class acc: %f' % confusion.mean_accuracy())
 
             iou_per_class_str = '------- IoU --------\n'
-            for l in range(NUM_CLASSES):
-                denom = float(total_iou_deno_class[l])
-
-                if denom == 0:
-                    tmp = denom
-                else:
-                    tmp = total_correct_class[l] / float(total_iou_deno_class[l])
-
+            for l, iou in enumerate(confusion.iou()):
                 iou_per_class_str += 'class %s weight: %.3f, IoU: %.3f \n' % (
                     seg_label_to_cat[l]
                     + ' ' * (14 - len(seg_label_to_cat[l])),
-                    labelweights[l - 1], tmp)
+                    labelweights[l - 1], iou)
 
             log_string(iou_per_class_str)
             log_string('Eval mean loss: %f' % (loss_sum / num_batches))
-            log_string('Eval accuracy: %f' % (total_correct / float(total_seen)))
+            log_string('Eval accuracy: %f' % accuracy)
 
 
             if mIoU >= best_iou:
@@ -333,7 +832,7 @@ def modelTraining(start_epoch, endepoch, alearning_rate, alr_decay, astep_size,
                 log_string('Saving model....')
             log_string('Best mIoU: %f' % best_iou)
             
-            tmpAcc = (total_correct / float(total_seen))
+            tmpAcc = accuracy
             tmpML = (loss_sum / num_batches)
             
             accuracyChart.append(tmpAcc)
@@ -347,13 +846,19 @@ def modelTraining(start_epoch, endepoch, alearning_rate, alr_decay, astep_size,
 
 
 '''Testing'''
-def add_vote(vote_label_pool, point_idx, pred_label, weight):
-    B = pred_label.shape[0]
-    N = pred_label.shape[1]
-    for b in range(B):
-        for n in range(N):
-            if weight[b, n] != 0 and not np.isinf(weight[b, n]):
-                vote_label_pool[int(point_idx[b, n]), int(pred_label[b, n])] += 1
+def add_vote(vote_label_pool, point_idx, pred_label, weight, pred_prob=None):
+    # Accumulate the votes of a whole batch at once, points with zero or infinite weight do not vote
+    # pred_prob: optional B x N x C class probabilities, adds soft votes instead of one count per argmax
+    num_classes = vote_label_pool.shape[1]
+    valid = (weight != 0) & ~np.isinf(weight)
+    point_idx = point_idx[valid].astype(np.int64, copy=False)
+    flat_pool = vote_label_pool.reshape(-1)  # view, the pool is contiguous
+    if pred_prob is None:
+        flat_idx = point_idx * num_classes + pred_label[valid].astype(np.int64)
+        np.add.at(flat_pool, flat_idx, 1)
+    else:
+        flat_idx = (point_idx[:, np.newaxis] * num_classes + np.arange(num_classes)).reshape(-1)
+        np.add.at(flat_pool, flat_idx, pred_prob[valid].reshape(-1))
     return vote_label_pool
 
 
@@ -363,36 +868,37 @@ def modelTesting(dataset, NUM_CLASSES, NUM_POINT, BATCH_SIZE, args, timezone,
     scene_id = [x[:-4] for x in scene_id]
     num_batches = len(dataset)
 
-    total_seen_class = [0 for _ in range(NUM_CLASSES)]
-    total_correct_class = [0 for _ in range(NUM_CLASSES)]
-    total_iou_deno_class = [0 for _ in range(NUM_CLASSES)]
+    # Whole test set, every scene is merged into it
+    confusion = ConfusionMatrix(NUM_CLASSES)
+
+    soft_vote = getattr(args, 'vote_mode', 'hard') == 'soft'
+    amp = getattr(args, 'amp', 'off')
+    device = next(classifier.parameters()).device
+    # npy by default, --visual keeps adding the pred/gt OBJ files
+    output_formats = list(getattr(args, 'output_format', ['npy']))
+    if args.visual and 'obj' not in output_formats:
+        output_formats.append('obj')
+    writer = PredictionWriter(output_formats, g_label2color, color=resultColor is True)
 
     log_string('---- EVALUATION WHOLE SCENE----')
 
     for batch_idx in range(num_batches):
         print("Inference [%d/%d] %s ..." % (batch_idx + 1, num_batches, scene_id[batch_idx]))
-        total_seen_class_tmp = [0 for _ in range(NUM_CLASSES)]
-        total_correct_class_tmp = [0 for _ in range(NUM_CLASSES)]
-        total_iou_deno_class_tmp = [0 for _ in range(NUM_CLASSES)]
-
-        if args.visual:
-            fout = open(os.path.join(visual_dir, scene_id[batch_idx] + '_pred.obj'), 'w')
-            fout_gt = open(os.path.join(visual_dir, scene_id[batch_idx] + '_gt.obj'), 'w')
-
         whole_scene_data = dataset.scene_points_list[batch_idx]
+        scene_origin = dataset.room_origin[batch_idx] if hasattr(dataset, 'room_origin') else np.zeros(3)
         whole_scene_label = dataset.semantic_labels_list[batch_idx]
-        vote_label_pool = np.zeros((whole_scene_label.shape[0], NUM_CLASSES))
+        vote_label_pool = np.zeros((whole_scene_label.shape[0], NUM_CLASSES), dtype=np.float32 if soft_vote else np.int32)
 
         for _ in tqdm(range(args.num_votes), total=args.num_votes):
             CurrentTime(timezone)
             scene_data, scene_label, scene_smpw, scene_point_index = dataset[batch_idx]
             num_blocks = scene_data.shape[0]
             s_batch_num = (num_blocks + BATCH_SIZE - 1) // BATCH_SIZE
-            batch_data = np.zeros((BATCH_SIZE, NUM_POINT, num_of_features))  # Change to number of features being used 6+x
+            batch_data = np.zeros((BATCH_SIZE, NUM_POINT, num_of_features), dtype=FEATURE_DTYPE)  # Change to number of features being used 6+x
 
-            batch_label = np.zeros((BATCH_SIZE, NUM_POINT))
-            batch_point_index = np.zeros((BATCH_SIZE, NUM_POINT))
-            batch_smpw = np.zeros((BATCH_SIZE, NUM_POINT))
+            batch_label = np.zeros((BATCH_SIZE, NUM_POINT), dtype=LABEL_DTYPE)
+            batch_point_index = np.zeros((BATCH_SIZE, NUM_POINT), dtype=np.int64)
+            batch_smpw = np.zeros((BATCH_SIZE, NUM_POINT), dtype=np.float32)
 
             for sbatch in range(s_batch_num):
                 start_idx = sbatch * BATCH_SIZE
@@ -403,86 +909,52 @@ def modelTesting(dataset, NUM_CLASSES, NUM_POINT, BATCH_SIZE, args, timezone,
                 batch_point_index[0:real_batch_size, ...] = scene_point_index[start_idx:end_idx, ...]
                 batch_smpw[0:real_batch_size, ...] = scene_smpw[start_idx:end_idx, ...]
 
-                torch_data = torch.Tensor(batch_data)
-                torch_data = torch_data.float().cuda()
+                torch_data = torch.from_numpy(batch_data).to(device)
                 torch_data = torch_data.transpose(2, 1)
-                seg_pred, _ = classifier(torch_data)
+                with amp_autocast(torch_data.device, amp):
+                    seg_pred, _ = classifier(torch_data)
+                seg_pred = seg_pred.float()
                 batch_pred_label = seg_pred.contiguous().cpu().data.max(2)[1].numpy()
+                if soft_vote:
+                    batch_pred_prob = seg_pred.contiguous().exp().cpu().data.numpy()[0:real_batch_size, ...]
+                else:
+                    batch_pred_prob = None
 
                 vote_label_pool = add_vote(vote_label_pool, batch_point_index[0:real_batch_size, ...],
                                            batch_pred_label[0:real_batch_size, ...],
-                                           batch_smpw[0:real_batch_size, ...])
+                                           batch_smpw[0:real_batch_size, ...], batch_pred_prob)
 
 
 
         pred_label = np.argmax(vote_label_pool, 1)
 
-        for l in range(NUM_CLASSES):
-            total_seen_class_tmp[l] += np.sum((whole_scene_label == l))
-            total_correct_class_tmp[l] += np.sum((pred_label == l) & (whole_scene_label == l))
-            total_iou_deno_class_tmp[l] += np.sum(((pred_label == l) | (whole_scene_label == l)))
-            total_seen_class[l] += total_seen_class_tmp[l]
-            total_correct_class[l] += total_correct_class_tmp[l]
-            total_iou_deno_class[l] += total_iou_deno_class_tmp[l]
-
-        iou_map = np.array(total_correct_class_tmp) / (np.array(total_iou_deno_class_tmp, dtype=float) + 1e-6)
-        print(iou_map)
-        arr = np.array(total_seen_class_tmp)
-        tmp_iou = np.mean(iou_map[arr != 0])
+        scene_confusion = ConfusionMatrix(NUM_CLASSES).update(pred_label, whole_scene_label)
+        confusion.merge(scene_confusion)
+
+        print(scene_confusion.iou())
+        tmp_iou = scene_confusion.mean_iou(present_only=True)
         log_string('Mean IoU of %s: %.4f' % (scene_id[batch_idx], tmp_iou))
         print('----------------------------')
 
-        filename = os.path.join(visual_dir, scene_id[batch_idx] + '.txt')
-        with open(filename, 'w') as pl_save:
-            for i in pred_label:
-                pl_save.write(str(int(i)) + '\n')
-            pl_save.close()
-
-        
-
-        if args.visual:
-            if resultColor is True:
-
-                
-                for i in range(whole_scene_label.shape[0]):
-                    color = g_label2color[pred_label[i]]
-                    color_gt = g_label2color[whole_scene_label[i]]
-
-                    
-                    
-                    fout.write('v %f %f %f %d %d %d\n' % 
-                              (whole_scene_data[i, 0], whole_scene_data[i, 1], whole_scene_data[i, 2], 
-                               color[0], color[1],color[2]))
-                    fout_gt.write('v %f %f %f %d %d %d\n' % 
-                              (whole_scene_data[i, 0], whole_scene_data[i, 1], whole_scene_data[i, 2], 
-                               color_gt[0],color_gt[1], color_gt[2]))
-                
-
-                
-                
-            else:
-                for i in range(whole_scene_label.shape[0]):
-                    fout.write('v %f %f %f\n' % (
-                        whole_scene_data[i, 0], whole_scene_data[i, 1], whole_scene_data[i, 2]))
-                    fout_gt.write('v %f %f %f\n' % (
-                        whole_scene_data[i, 0], whole_scene_data[i, 1], whole_scene_data[i, 2]))
-          
-
-
-    IoU = np.array(total_correct_class) / (np.array(total_iou_deno_class, dtype=np.float64) + 1e-6)
+        room_files = getattr(dataset, 'room_files', [])
+        writer.write(os.path.join(visual_dir, scene_id[batch_idx]), whole_scene_data[:, 0:3] + scene_origin, pred_label,
+                     whole_scene_label, vote_confidence(vote_label_pool),
+                     room_files[batch_idx] if batch_idx < len(room_files) else None)
+
+
+    IoU = confusion.iou()
+    iou_denominator = confusion.iou_denominator()
+    precision, recall, f1 = confusion.precision(), confusion.recall(), confusion.f1()
     iou_per_class_str = '------- IoU --------\n'
     for l in range(NUM_CLASSES):
-        tmp = float(total_iou_deno_class[l])
-        if tmp == 0:
-            tmp = 0
-        else:
-            tmp = total_correct_class[l] / float(total_iou_deno_class[l])
-            iou_per_class_str += 'class %s, IoU: %.3f \n' % (
-                                  seg_label_to_cat[l] + ' ' * 
-                                  (14 - len(seg_label_to_cat[l])), tmp)
-                                  
+        if iou_denominator[l] != 0:
+            iou_per_class_str += 'class %s, IoU: %.3f, precision: %.3f, recall: %.3f, F1: %.3f \n' % (
+                                  seg_label_to_cat[l] + ' ' *
+                                  (14 - len(seg_label_to_cat[l])), IoU[l], precision[l], recall[l], f1[l])
+
     # Logging results
     log_string(iou_per_class_str)
     log_string('eval point avg class IoU: %f' % np.mean(IoU))
-    log_string('eval whole scene point avg class acc: %f' % (np.mean(np.array(total_correct_class) / (np.array(total_seen_class, dtype=np.float64) + 1e-6))))
-    log_string('eval whole scene point accuracy: %f' %      (np.sum(total_correct_class) / float(np.sum(total_seen_class) + 1e-6)))
\ No newline at end of file
+    log_string('eval whole scene point avg class acc: %f' % confusion.mean_accuracy())
+    log_string('eval whole scene point accuracy: %f' % confusion.overall_accuracy())
+    log_string('eval whole scene avg class F1: %f' % np.mean(f1))
@@ -22,17 +22,22 @@ import open3d as o3d
 import h5py
 import matplotlib.pyplot as plt
 import time
-from localfunctions import timePrint, CurrentTime, modelTesting
+from localfunctions import timePrint, CurrentTime, modelTesting, sliding_window_membership, sliding_window_blocks
+from localfunctions import save_columnar, load_columnar, is_columnar, legacy_pickle_path, read_las_chunked
+from localfunctions import LabelRemap, CLASS8_MAPPING, IGNORE_LABEL, gather_sample, append_feature_columns, normalize_features
+from localfunctions import COORD_DTYPES, FEATURE_DTYPE, LABEL_DTYPE, AMP_MODES, select_device
 from pathlib import Path
 from tqdm import tqdm
 from geofunction import cal_geofeature
+from models.pointnet2_utils import FPS_BACKENDS, set_fps_backend
+from predictions import OUTPUT_FORMATS
 
 '''Adjust permanent/file/static variables here'''
 
 timezone = pytz.timezone('Asia/Singapore')
 print("Check current time")
 CurrentTime(timezone)
-saveTest = "testdataset.pkl"
+saveTest = "testdataset"
 saveDir = "/content/Khairil_PN2_experiment/experiment/data/saved_data/"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -61,8 +66,14 @@ def parse_args():
     parser.add_argument('--log_dir', type=str, default='pointnet2_sem_seg', help='log directory')
     parser.add_argument('--exp_dir', type=str, default='log/sem_seg/', help='Log path [default: None]')
     parser.add_argument('--visual', action='store_true', default=False, help='visualize result [default: False]')
+    parser.add_argument('--output_format', nargs='+', default=['npy'], choices=OUTPUT_FORMATS,
+                        help='prediction files written per scene, --visual adds obj [default: npy]')
     parser.add_argument('--num_votes', type=int, default=5,
                         help='aggregate segmentation scores with voting [default: 5]')
+    parser.add_argument('--cache_tiling', default=False, action='store_true',
+                        help='compute the sliding windows once per scene and reuse them across votes')
+    parser.add_argument('--vote_mode', type=str, default='hard', choices=['hard', 'soft'],
+                        help='hard: count argmax labels, soft: sum class probabilities [default: hard]')
     parser.add_argument('--output_model', type=str, default='/best_model.pth', help='model output name')
     parser.add_argument('--test_area', type=str, default="cc_o_clipped_Local_DEBY_LOD2_4959323_cc.las",
                         help='Which area to use for test, option: 1-6 [default: 5]')
@@ -75,16 +86,38 @@ def parse_args():
     parser.add_argument('--extra_features', nargs='+', default=[], help='select which features  to add')
     parser.add_argument('--downsample', type=bool, default=False, help='downsample data')
     parser.add_argument('--calculate_geometry', type=bool, default=False, help='decide where to calculate geometry')
+    parser.add_argument('--geo_workers', type=int, default=1, help='processes for geometric features [default: 1]')
     parser.add_argument('--class8',  default=False, action="store_true", help='Select 17 classes or 8 classes data')
+    parser.add_argument('--coord_dtype', type=str, default='float32', choices=list(COORD_DTYPES),
+                        help='storage dtype of room coordinates relative to the room origin [default: float32]')
+    parser.add_argument('--fps', type=str, default='auto', choices=FPS_BACKENDS,
+                        help='farthest point sampling backend, auto uses numpy on CPU [default: auto]')
+    parser.add_argument('--amp', type=str, default='off', choices=list(AMP_MODES),
+                        help='mixed precision autocast, bf16 also runs on CPU [default: off]')
+    parser.add_argument('--channels_last', default=False, action="store_true",
+                        help='keep the set abstraction convolutions in channels-last memory format')
+    parser.add_argument('--device', type=str, default='auto', help='cpu, cuda, cuda:N or auto [default: auto]')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads on CPU, 0 keeps the default [default: 0]')
+    parser.add_argument('--class_mapping', type=str, default=None, help='JSON label mapping file, overrides --class8 [default: None]')
 
     return parser.parse_args()
 
 ''''''
 
+def balanced_labelweights(counts):
+    # (max frequency / frequency) ^ 1/3 per class, ones when no point has a mapped label
+    labelweights = np.asarray(counts, dtype=np.float32)
+    if np.sum(labelweights) == 0:
+        return np.ones(len(labelweights), dtype=np.float32)
+    labelweights = labelweights / np.sum(labelweights)  # normalize weights to 1
+    return np.power(np.amax(labelweights) / labelweights, 1 / 3.0)  # balance weights
+
+
 class TestCustomDataset():
     # prepare to give prediction on each points
     def __init__(self, root, las_file_list='trainval_fullarea', feature_list=[], num_classes=8, block_points=4096, stride=0.5,
-                 block_size=1.0, padding=0.001, class8 = True):
+                 block_size=1.0, padding=0.001, class8 = True, cache_tiling=False, label_remap=None,
+                 coord_dtype=np.float32):
         self.block_points = block_points
         self.block_size = block_size
         self.padding = padding
@@ -94,12 +127,18 @@ class TestCustomDataset():
         self.scene_points_list = []
         self.semantic_labels_list = []
         self.room_coord_min, self.room_coord_max = [], []
+        self.room_origin = [] # float64 origin of every scene, scene_points_list is relative to it
+        self.room_files = []
         self.labelweights = np.zeros(num_classes)
         self.num_extra_features = 0
         self.num_classes = num_classes
         self.feature_name = []
 
-        # For Extra Features
+        # Window membership per scene, reused across votes when cache_tiling is set
+        self.cache_tiling = cache_tiling
+        self.tiling_cache = {}
+
+        # For Extra Features, one N x F float32 matrix per scene with colours already scaled to [0, 1]
         self.extra_features_data = []
         self.non_index = []
 
@@ -111,8 +150,6 @@ class TestCustomDataset():
         adjustedclass = num_classes
         range_class = adjustedclass + 1
 
-        new_class_mapping = {1: 0, 2: 1, 3: 2, 6: 3, 13: 4, 11: 5, 7: 6, 8: 7}
-
         if dataColor is True:        
             feature_list.append("red")
             feature_list.append("blue")
@@ -123,43 +160,29 @@ class TestCustomDataset():
             self.feature_name.append(feature)
 
 
+        # One lookup table remaps every chunk as it is read
+        if label_remap is None and class8 is True:
+            label_remap = LabelRemap(CLASS8_MAPPING)
+
         for files in self.file_list:
             file_path = os.path.join(root, files)
             # Read LAS file
             print("Reading = " + file_path)
-            in_file = laspy.read(file_path)
-            points = np.vstack((in_file.x, in_file.y, in_file.z)).T
-            labels = np.array(in_file.classification, dtype=np.int32)
-            
-
-            tmp_features = []
-            for feature in feature_list:
-                # Retrieve the variable with the same name as the feature from `las_data`
-                feature_value = getattr(in_file, feature)
-                tmp_features.append(feature_value)
+            self.room_files.append(file_path)
+            # Stream the file into float32 coordinates relative to the room origin
+            points, labels, tmp_features, origin = read_las_chunked(file_path, feature_list, label_remap,
+                                                                    coord_dtype=coord_dtype)
+            if label_remap is not None and np.any(labels == IGNORE_LABEL):
+                print("Warning: %d points with unmapped labels in %s" % (np.count_nonzero(labels == IGNORE_LABEL), file_path))
 
             if self.num_extra_features > 0:
                 self.extra_features_data.append(tmp_features)
 
-            # Reduce number of labels
-            if class8 is True:
-                # Merge labels as per instructions
-                labels[(labels == 5) | (labels == 6)] = 6  # Merge molding and decoration
-                labels[(labels == 1) | (labels == 9) | (labels == 15) | (
-                        labels == 10)] = 1  # Merge wall, drainpipe, outer ceiling surface, and stairs
-                labels[(labels == 12) | (labels == 11)] = 11  # Merge terrain and ground surface
-                labels[(labels == 13) | (labels == 16) | (labels == 17)] = 13  # Merge interior, roof, and other
-                labels[labels == 14] = 2  # Add blinds to window
-
-                # Map merged labels to new labels (0 to 7)
-                labels = np.vectorize(new_class_mapping.get)(labels)
-
-
             #Compile the data extracted
-            data = np.hstack((points, labels.reshape((-1, 1))))
-            self.scene_points_list.append(data[:, :3])
-            self.semantic_labels_list.append(data[:, 3])
-            coord_min, coord_max = np.amin(points, axis=0)[:3], np.amax(points, axis=0)[:3]
+            self.scene_points_list.append(points)
+            self.semantic_labels_list.append(labels)
+            self.room_origin.append(origin)
+            coord_min, coord_max = origin + np.amin(points, axis=0)[:3], origin + np.amax(points, axis=0)[:3]
             self.room_coord_min.append(coord_min), self.room_coord_max.append(coord_max)
             
         assert len(self.scene_points_list) == len(self.semantic_labels_list)
@@ -169,73 +192,28 @@ class TestCustomDataset():
             tmp, _ = np.histogram(seg, range(range_class))
             self.scene_points_num.append(seg.shape[0])
             labelweights += tmp
-        labelweights = labelweights.astype(np.float32)
-        labelweights = labelweights / np.sum(labelweights)
-        self.labelweights = np.power(np.amax(labelweights) / labelweights, 1 / 3.0)
+        self.labelweights = balanced_labelweights(labelweights)
 
     def __getitem__(self, index):
         point_set_ini = self.scene_points_list[index]
         points = point_set_ini[:, :3]
         labels = self.semantic_labels_list[index]
-        coord_min, coord_max = np.amin(points, axis=0)[:3], np.amax(points, axis=0)[:3]
-        grid_x = int(np.ceil(float(coord_max[0] - coord_min[0] - self.block_size) / self.stride) + 1)
-        grid_y = int(np.ceil(float(coord_max[1] - coord_min[1] - self.block_size) / self.stride) + 1)
-        data_room, label_room, sample_weight, index_room = np.array([]), np.array([]), np.array([]), np.array([])
-
+        origin = self.room_origin[index]
+        coord_max = origin + np.amax(points, axis=0)[:3]
         extra_num = self.num_extra_features
 
-        for index_y in range(grid_y):
-            for index_x in range(grid_x):
-                s_x = coord_min[0] + index_x * self.stride
-                e_x = min(s_x + self.block_size, coord_max[0])
-                s_x = e_x - self.block_size
-                s_y = coord_min[1] + index_y * self.stride
-                e_y = min(s_y + self.block_size, coord_max[1])
-                s_y = e_y - self.block_size
-                point_idxs = np.where((points[:, 0] >= s_x - self.padding) & (points[:, 0] <= e_x + self.padding) &
-                                      (points[:, 1] >= s_y - self.padding) & (points[:, 1] <= e_y + self.padding))[0]
-                if point_idxs.size == 0:
-                    continue
-
-                num_batch = int(np.ceil(point_idxs.size / self.block_points))
-                point_size = int(num_batch * self.block_points)
-                replace = False if (point_size - point_idxs.size <= point_idxs.size) else True
-                point_idxs_repeat = np.random.choice(point_idxs, point_size - point_idxs.size, replace=replace)
-                point_idxs = np.concatenate((point_idxs, point_idxs_repeat))
-                np.random.shuffle(point_idxs)
-                data_batch = points[point_idxs, :]
-                normlized_xyz = np.zeros((point_size, 3))
-                normlized_xyz[:, 0] = data_batch[:, 0] / coord_max[0]
-                normlized_xyz[:, 1] = data_batch[:, 1] / coord_max[1]
-                normlized_xyz[:, 2] = data_batch[:, 2] / coord_max[2]
-                data_batch[:, 0] = data_batch[:, 0] - (s_x + self.block_size / 2.0)
-                data_batch[:, 1] = data_batch[:, 1] - (s_y + self.block_size / 2.0)
-                data_batch = np.concatenate((data_batch, normlized_xyz), axis=1)
-                label_batch = labels[point_idxs].astype(int)
-                batch_weight = self.labelweights[label_batch]
-                
-                # Extra Feature to be included
-                if extra_num > 0:
-                    tmp_features = []
-                    tmp_np_features = np.zeros((point_size, extra_num))
-                    for ix in  range(extra_num):
-                        features_room = self.extra_features_data[index] # Load the selected room features
-                        tmp_feature_name = self.feature_name[ix]
-                        features_points = features_room[ix]
-                        selected_feature = features_points[point_idxs]  # num_point * lp_features
-                        if tmp_feature_name == 'red' or tmp_feature_name == 'blue' or tmp_feature_name == 'green':
-                            selected_feature = selected_feature/255
-                        np_feature_array = np.array(selected_feature)
-                        tmp_np_features[:,ix] = np_feature_array
-
-                    data_batch = np.concatenate((data_batch, tmp_np_features), axis=1)
-                
-                
-                #Compile extracted data
-                data_room = np.vstack([data_room, data_batch]) if data_room.size else data_batch
-                label_room = np.hstack([label_room, label_batch]) if label_room.size else label_batch
-                sample_weight = np.hstack([sample_weight, batch_weight]) if label_room.size else batch_weight
-                index_room = np.hstack([index_room, point_idxs]) if index_room.size else point_idxs
+        # Tile the room into windows in one pass, then draw every window's random fill and order
+        window_points, window_start, window_centre = self.window_membership(index)
+        positions, slot_window = sliding_window_blocks(window_start, self.block_points)
+        index_room = window_points[positions]
+
+        # Gather every block into one preallocated array
+        features = self.extra_features_data[index] if extra_num > 0 else None
+        data_room = np.empty((index_room.size, 6 + extra_num), dtype=FEATURE_DTYPE)
+        gather_sample(points, features, index_room, origin / coord_max, 1.0 / coord_max, data_room)
+        data_room[:, 0:2] -= window_centre[slot_window]
+        label_room = labels[index_room]
+        sample_weight = self.weight_table()[label_room]
 
         data_room = data_room.reshape((-1, self.block_points, data_room.shape[1]))
         label_room = label_room.reshape((-1, self.block_points))
@@ -244,6 +222,25 @@ class TestCustomDataset():
 
         return data_room, label_room, sample_weight, index_room
 
+    def weight_table(self):
+        # Sample weight of every possible uint8 label. Unmapped labels (IGNORE_LABEL) get 1 so that whether a
+        # point is predicted never depends on its ground truth, the metrics drop them anyway
+        weights = np.ones(256, dtype=np.float32)
+        weights[:len(self.labelweights)] = self.labelweights
+        return weights
+
+    def window_membership(self, index):
+        # Only the random fill and shuffle differ between votes, the windows themselves can be kept
+        cache_tiling = getattr(self, 'cache_tiling', False)
+        if cache_tiling and index in self.tiling_cache:
+            return self.tiling_cache[index]
+
+        points = self.scene_points_list[index][:, :3]
+        membership = sliding_window_membership(points, self.block_size, self.stride, self.padding)
+        if cache_tiling:
+            self.tiling_cache[index] = membership
+        return membership
+
     def __len__(self):
         return len(self.scene_points_list)
 
@@ -257,9 +254,14 @@ class TestCustomDataset():
         tmp_scene_points_num = []
         tmp_scene_points_list = [self.scene_points_list[i] for i in new_indices]
         tmp_semantic_labels_list = [self.semantic_labels_list[i] for i in new_indices]
+        self.room_files = [self.room_files[i] for i in new_indices]
+        self.room_origin = [self.room_origin[i] for i in new_indices]
+        if self.num_extra_features > 0:
+            self.extra_features_data = [self.extra_features_data[i] for i in new_indices]
 
         self.scene_points_list = tmp_scene_points_list
         self.semantic_labels_list = tmp_semantic_labels_list
+        self.tiling_cache = {}
 
         # Recompute labelweights
         num_classes = len(self.labelweights)
@@ -269,13 +271,17 @@ class TestCustomDataset():
             tmp, _ = np.histogram(seg, range(num_classes + 1))
             tmp_scene_points_num.append(seg.shape[0])
             labelweights += tmp
-        labelweights = labelweights.astype(np.float32)
-        labelweights = labelweights / np.sum(labelweights)
-        self.labelweights = np.power(np.amax(labelweights) / labelweights, 1 / 3.0)
+        self.labelweights = balanced_labelweights(labelweights)
         self.scene_points_num = tmp_scene_points_num
 
+    def add_features(self, names, columns): # append per-point columns given over all scenes concatenated
+        room_sizes = [len(points) for points in self.scene_points_list]
+        self.extra_features_data = append_feature_columns(self.extra_features_data, columns, room_sizes)
+        self.feature_name = list(self.feature_name) + list(names)
+        self.num_extra_features += len(names)
+
     def copy(self, new_indices=None): #Copy target dataset but adjust index if needed
-        new_dataset = TestCustomDataset()
+        new_dataset = TestCustomDataset(None, None)
         new_dataset.block_points = self.block_points
         new_dataset.block_size = self.block_size
         new_dataset.padding = self.padding
@@ -286,11 +292,15 @@ class TestCustomDataset():
         new_dataset.room_coord_max = self.room_coord_max
         new_dataset.non_index = self.non_index
         new_dataset.num_extra_features = self.num_extra_features
-        new_dataset.extra_features_data = self.extra_features_data
         new_dataset.feature_name = self.feature_name
+        new_dataset.cache_tiling = getattr(self, 'cache_tiling', False)
 
         new_dataset.scene_points_list = [self.scene_points_list[i] for i in new_indices]
         new_dataset.semantic_labels_list = [self.semantic_labels_list[i] for i in new_indices]
+        new_dataset.room_files = [self.room_files[i] for i in new_indices]
+        new_dataset.room_origin = [self.room_origin[i] for i in new_indices]
+        if self.num_extra_features > 0:
+            new_dataset.extra_features_data = [self.extra_features_data[i] for i in new_indices]
 
         labelweights, tmp_scene_points_num = new_dataset.calculate_labelweights()
         new_dataset.labelweights = labelweights
@@ -311,27 +321,61 @@ class TestCustomDataset():
             labelweights += tmp
 
         print(labelweights)
-        labelweights = labelweights.astype(np.float32)
-        labelweights = labelweights / np.sum(labelweights)  # normalize weights to 1
-        labelweights = np.power(np.amax(labelweights) / labelweights, 1 / 3.0)  # balance weights
+        labelweights = balanced_labelweights(labelweights)
 
         print(labelweights)
         assert len(labelweights) == num_classes
 
         return labelweights, tmp_scene_points_num
 
-    def save_data(self, file_path):
-        with open(file_path, 'wb') as f:
-            pickle.dump(self, f)
+    def save_data(self, file_path): # Save extracted dataset, one array file per attribute + manifest.json
+        attributes = {'block_points': self.block_points, 'block_size': self.block_size, 'padding': self.padding,
+                      'stride': self.stride, 'num_classes': self.num_classes,
+                      'num_extra_features': self.num_extra_features, 'feature_name': list(self.feature_name),
+                      'file_list': list(self.file_list), 'room_files': list(self.room_files),
+                      'non_index': [int(i) for i in self.non_index],
+                      'scene_points_num': [int(n) for n in self.scene_points_num],
+                      'labelweights': np.asarray(self.labelweights).tolist(),
+                      'room_coord_min': [np.asarray(c).tolist() for c in self.room_coord_min],
+                      'room_coord_max': [np.asarray(c).tolist() for c in self.room_coord_max],
+                      'room_origin': [np.asarray(c).tolist() for c in self.room_origin]}
+        arrays = {'scene_points': self.scene_points_list,
+                  'semantic_labels': [np.asarray(labels, dtype=np.uint8) for labels in self.semantic_labels_list]}
+        if self.num_extra_features > 0:
+            arrays['room_features'] = self.extra_features_data
+        save_columnar(file_path, attributes, arrays)
 
     @staticmethod
-    def load_data(file_path):
-        with open(file_path, 'rb') as f:
-            dataset = pickle.load(f)
+    def load_data(file_path): # Load extracted dataset, memory-mapped
+        if not is_columnar(file_path):
+            with open(legacy_pickle_path(file_path), 'rb') as f: # Dataset pickled by an older version
+                dataset = pickle.load(f)
+            dataset.semantic_labels_list = [np.asarray(labels).astype(LABEL_DTYPE) for labels in dataset.semantic_labels_list]
+            if not hasattr(dataset, 'room_origin'): # absolute float64 coordinates
+                dataset.room_origin = [np.amin(points[:, :3], axis=0) for points in dataset.scene_points_list]
+                dataset.scene_points_list = [(points[:, :3] - origin).astype(np.float32)
+                                             for points, origin in zip(dataset.scene_points_list, dataset.room_origin)]
+            if dataset.num_extra_features > 0 and isinstance(dataset.extra_features_data[0], list): # one array per feature
+                dataset.extra_features_data = [normalize_features(np.stack(features_room, axis=1).astype(np.float32),
+                                                                  dataset.feature_name)
+                                               for features_room in dataset.extra_features_data]
+        else:
+            attributes, arrays = load_columnar(file_path)
+            dataset = TestCustomDataset(None, None)
+            for name in ['block_points', 'block_size', 'padding', 'stride', 'num_classes', 'num_extra_features',
+                         'feature_name', 'file_list', 'room_files', 'non_index', 'scene_points_num']:
+                setattr(dataset, name, attributes[name])
+            dataset.labelweights = np.array(attributes['labelweights'])
+            dataset.room_coord_min = [np.array(c) for c in attributes['room_coord_min']]
+            dataset.room_coord_max = [np.array(c) for c in attributes['room_coord_max']]
+            dataset.room_origin = [np.array(c) for c in attributes['room_origin']]
+            dataset.scene_points_list = arrays['scene_points']
+            dataset.semantic_labels_list = arrays['semantic_labels']
+            dataset.extra_features_data = arrays.get('room_features', [])
 
         print("Extra features to be included = %d" % dataset.num_extra_features)
         print("Number of Classes in dataset = %d" %dataset.num_classes)
-        print("Totally {} samples in dataset.".format(len(dataset.room_idxs)))
+        print("Totally {} scenes in dataset.".format(len(dataset)))
         return dataset
 
 
@@ -343,7 +387,12 @@ def main(args):
     print(args.class8)
     
     '''Initialize'''
-    if args.class8 is False:
+    label_remap = None
+    if args.class_mapping is not None:
+        label_remap = LabelRemap.from_file(args.class_mapping)
+        NUM_CLASSES = label_remap.num_classes
+        classes = label_remap.classes if label_remap.classes is not None else ['class %d' % i for i in range(NUM_CLASSES)]
+    elif args.class8 is False:
         classes = classes_18
         NUM_CLASSES = NUM_CLASSES_18
     else:
@@ -377,6 +426,8 @@ def main(args):
 
     '''HYPER PARAMETER'''
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    device = select_device(args.device, args.num_threads)
+    print("Device = %s" % device)
     if args.exp_dir is None:
         tmp_dir = 'log/sem_seg/'
     else:
@@ -416,23 +467,19 @@ def main(args):
             if 'Surface variation' in feature_list:
                 tmp_feature_list.remove('Surface variation')
                 
-        TEST_DATASET_WHOLE_SCENE = TestCustomDataset(root, test_file, tmp_feature_list, num_classes=NUM_CLASSES, block_points=NUM_POINT, class8=args.class8)
+        TEST_DATASET_WHOLE_SCENE = TestCustomDataset(root, test_file, tmp_feature_list, num_classes=NUM_CLASSES, block_points=NUM_POINT, class8=args.class8,
+                                                     cache_tiling=args.cache_tiling, label_remap=label_remap,
+                                                     coord_dtype=COORD_DTYPES[args.coord_dtype])
 
         if args.calculate_geometry is True:
             print("room_idx test")
             print(len(TEST_DATASET_WHOLE_SCENE))
-            lp, lo, lc, non_index = cal_geofeature(TEST_DATASET_WHOLE_SCENE, args.downsample, args.visualizeModel)
+            lp, lo, lc, non_index = cal_geofeature(TEST_DATASET_WHOLE_SCENE, args.downsample, args.visualizeModel, args.geo_workers)
 
             # Store the additional features in the CustomDataset instance
-            if 'Planarity' in feature_list:
-                TEST_DATASET_WHOLE_SCENE.extra_features_data.append(lp)
-                TEST_DATASET_WHOLE_SCENE.num_extra_features+=1
-            if 'Omnivariance' in feature_list:
-                TEST_DATASET_WHOLE_SCENE.extra_features_data.append(lo)
-                TEST_DATASET_WHOLE_SCENE.num_extra_features+=1
-            if 'Surface variation' in feature_list:
-                TEST_DATASET_WHOLE_SCENE.extra_features_data.append(lc)
-                TEST_DATASET_WHOLE_SCENE.num_extra_features+=1
+            geo_columns = {'Planarity': lp, 'Omnivariance': lo, 'Surface variation': lc}
+            geo_names = [name for name in geo_columns if name in args.extra_features]
+            TEST_DATASET_WHOLE_SCENE.add_features(geo_names, [geo_columns[name] for name in geo_names])
             
             TEST_DATASET_WHOLE_SCENE.non_index = non_index
             # Filter the points and labels using the non_index variable
@@ -444,6 +491,8 @@ def main(args):
             print(len(TEST_DATASET_WHOLE_SCENE))
     else:
         TEST_DATASET_WHOLE_SCENE = TestCustomDataset.load_data(saveDir + saveTest)
+        TEST_DATASET_WHOLE_SCENE.cache_tiling = args.cache_tiling
+        TEST_DATASET_WHOLE_SCENE.tiling_cache = {}
 
     log_string("The number of test data is: %d" % len(TEST_DATASET_WHOLE_SCENE))
     print("wall", "window", "door", "molding", "other", "terrain", "column", "arch") # Adjust according to dataset
@@ -467,19 +516,22 @@ def main(args):
         model_dir = tmp_model
     print(model_dir)
     MODEL = importlib.import_module(model_dir)
+    set_fps_backend(args.fps)
     num_extra_features = TEST_DATASET_WHOLE_SCENE.num_extra_features
     print("number = %d" % num_extra_features)
 
-    classifier = MODEL.get_model(NUM_CLASSES, num_extra_features).cuda()  # name sensitive but not case sensitive
-    checkpoint = torch.load(str(experiment_dir) + '/checkpoints' + model_name)
+    classifier = MODEL.get_model(NUM_CLASSES, num_extra_features).to(device)  # name sensitive but not case sensitive
+    checkpoint = torch.load(str(experiment_dir) + '/checkpoints' + model_name, map_location=device)
     classifier.load_state_dict(checkpoint['model_state_dict'])
     classifier = classifier.eval()
+    if args.channels_last is True:
+        classifier = classifier.to(memory_format=torch.channels_last)
 
     num_of_features = 6 + num_extra_features
 
 
     '''Model testing'''
-    with torch.no_grad():
+    with torch.inference_mode():
         print("Begin testing")
         modelTesting(TEST_DATASET_WHOLE_SCENE, NUM_CLASSES, NUM_POINT, BATCH_SIZE, args, timezone,
                      num_of_features, log_string, visual_dir, classifier, seg_label_to_cat, True)
@@ -26,20 +26,25 @@ import time
 import pickle
 import h5py
 import provider
+from augmentation import AUGMENTATIONS, build_augmentation
 import open3d as o3d
 from tqdm import tqdm
-from localfunctions import timePrint, CurrentTime, inplace_relu, modelTraining
+from localfunctions import timePrint, CurrentTime, inplace_relu, modelTraining, GridIndex2D, valid_block_centres
+from localfunctions import save_columnar, load_columnar, is_columnar, legacy_pickle_path, read_las_chunked
+from localfunctions import LabelRemap, CLASS8_MAPPING, IGNORE_LABEL, gather_sample, append_feature_columns, normalize_features
+from localfunctions import COORD_DTYPES, FEATURE_DTYPE, LABEL_DTYPE, GeometryCollate, AMP_MODES, select_device
 from collections import Counter
 from torch.utils.data import Dataset, DataLoader, random_split
 from geofunction import cal_geofeature
+from models.pointnet2_utils import FPS_BACKENDS, set_fps_backend
 
 '''Adjust permanent/file/static variables here'''
 
 timezone = pytz.timezone('Asia/Singapore')
 print("Check current time")
 CurrentTime(timezone)
-saveTrain = "traindataset.pkl" # save file name for training
-saveEval = "evaldataset.pkl" # save file name for evaluation
+saveTrain = "traindataset" # save directory name for training
+saveEval = "evaldataset" # save directory name for evaluation
 saveDir = "/content/Khairil_PN2_experiment/experiment/data/saved_data/"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 train_ratio = 0.7
@@ -54,7 +59,6 @@ NUM_CLASSES_18 = 18
 # 0: wall, # 1: window, # 2: door, # 3: molding, # 4: other, # 5: terrain, # 6: column, # 7: arch
 classes_8 = ["wall", "window", "door", "molding", "other", "terrain", "column", "arch"]
 NUM_CLASSES_8 = 8
-new_class_mapping = {1: 0, 2: 1, 3: 2, 6: 3, 13: 4, 11: 5, 7: 6, 8: 7}
 
 # Adjust parameters here if there no changes to reduce line
 def parse_args():
@@ -84,15 +88,43 @@ def parse_args():
     parser.add_argument('--extra_features', nargs='+', default=[], help='select which features  to add')
     parser.add_argument('--downsample', type=bool, default=False, help='downsample data')
     parser.add_argument('--calculate_geometry', type=bool, default=False, help='decide where to calculate geometry')
+    parser.add_argument('--geo_workers', type=int, default=1, help='processes for geometric features [default: 1]')
     parser.add_argument('--class8',  default=False, action="store_true", help='Select 17 classes or 8 classes data')
+    parser.add_argument('--coord_dtype', type=str, default='float32', choices=list(COORD_DTYPES),
+                        help='storage dtype of room coordinates relative to the room origin [default: float32]')
+    parser.add_argument('--augment', nargs='+', default=['rotate_z'], choices=list(AUGMENTATIONS) + ['none'],
+                        help='batch augmentations applied on the device, in order [default: rotate_z]')
+    parser.add_argument('--fps', type=str, default='auto', choices=FPS_BACKENDS,
+                        help='farthest point sampling backend, auto uses numpy on CPU [default: auto]')
+    parser.add_argument('--precompute_geometry', default=False, action="store_true",
+                        help='compute sampling and grouping indices in the DataLoader workers')
+    parser.add_argument('--amp', type=str, default='off', choices=list(AMP_MODES),
+                        help='mixed precision autocast, bf16 also runs on CPU [default: off]')
+    parser.add_argument('--channels_last', default=False, action="store_true",
+                        help='keep the set abstraction convolutions in channels-last memory format')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='batches prepared on the device ahead of the training step, 0 disables [default: 2]')
+    parser.add_argument('--device', type=str, default='auto', help='cpu, cuda, cuda:N or auto [default: auto]')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads on CPU, 0 keeps the default [default: 0]')
+    parser.add_argument('--class_mapping', type=str, default=None, help='JSON label mapping file, overrides --class8 [default: None]')
     return parser.parse_args()
 
 
 ''''''''''''''''''''''''''''''''''''''''''''''''
 
+def block_centres(points, grid, block_size, room_path, min_points=1024):
+    # Centres of the blocks holding more than min_points points, every point when no block does
+    centres = valid_block_centres(points, grid, block_size, min_points=min_points)
+    if centres.size == 0:
+        print("No block in %s holds more than %d points, sampling from all points" % (room_path, min_points))
+        centres = np.arange(len(points))
+    return centres
+
+
 class TrainCustomDataset(Dataset): # Dataset class to extract point cloud model and prepare for PointNet/PointNet++
     def __init__(self, las_file_list=None, feature_list=[], num_classes=8, num_point=4096, block_size=1.0,
-                 sample_rate=1.0, transform=None, indices=None, class8 = True):
+                 sample_rate=1.0, transform=None, indices=None, class8 = True, label_remap=None,
+                 coord_dtype=np.float32):
         super().__init__()
         self.num_point = num_point
         self.block_size = block_size
@@ -101,9 +133,12 @@ class TrainCustomDataset(Dataset): # Dataset class to extract point cloud model
         self.num_extra_features = 0
         self.room_points, self.room_labels = [], []
         self.room_coord_min, self.room_coord_max = [], []
+        self.room_origin = [] # float64 origin of every room, room_points are relative to it
+        self.room_grids, self.room_centres = [], []
+        self.room_files = []
         self.feature_name = []
 
-        # For Extra Features
+        # For Extra Features, one N x F float32 matrix per room with colours already scaled to [0, 1]
         self.extra_features_data = []
         self.non_index = []
 
@@ -132,54 +167,39 @@ class TrainCustomDataset(Dataset): # Dataset class to extract point cloud model
             self.num_extra_features += 1
             self.feature_name.append(feature)
 
+        # One lookup table remaps every chunk as it is read
+        if label_remap is None and class8 is True:
+            label_remap = LabelRemap(CLASS8_MAPPING)
+
         for room_path in rooms:
             # Read LAS file
             print("Reading = " + room_path)
-            las_data = laspy.read(room_path)
-            coords = np.vstack((las_data.x, las_data.y, las_data.z)).transpose()
-            labels = np.array(las_data.classification, dtype=np.uint8)
-
-            # Find available properties debug
-            # available_properties = las_data.point_format.dimension_names
-            # print("Available properties:")
-            # for prop in available_properties:
-                # print(prop)
-
+            self.room_files.append(room_path)
+            # Stream the file into float32 coordinates relative to the room origin
+            points, labels, tmp_features, origin = read_las_chunked(room_path, feature_list, label_remap,
+                                                                    coord_dtype=coord_dtype)
+            if label_remap is not None and np.any(labels == IGNORE_LABEL):
+                print("Warning: %d points with unmapped labels in %s, ignored by the loss" % (np.count_nonzero(labels == IGNORE_LABEL), room_path))
 
             # Get extra features
-            tmp_features = []
-            for feature in feature_list:
-                # Retrieve the variable with the same name as the feature from `las_data`
-                feature_value = getattr(las_data, feature)
-                tmp_features.append(feature_value)
-
             if self.num_extra_features > 0:
                 self.extra_features_data.append(tmp_features)
 
-            # Reduce number of labels
-            if class8 is True:
-                # Merge labels as per instructions
-                labels[(labels == 5) | (labels == 6)] = 6  # Merge molding and decoration
-                labels[(labels == 1) | (labels == 9) | (labels == 15) | (
-                        labels == 10)] = 1  # Merge wall, drainpipe, outer ceiling surface, and stairs
-                labels[(labels == 12) | (labels == 11)] = 11  # Merge terrain and ground surface
-                labels[(labels == 13) | (labels == 16) | (labels == 17)] = 13  # Merge interior, roof, and other
-                labels[labels == 14] = 2  # Add blinds to window
-
-                # Map merged labels to new labels (0 to 7)
-                labels = np.vectorize(new_class_mapping.get)(labels)
-
-            room_data = np.concatenate((coords, labels[:, np.newaxis]), axis=1)  # xyzl, N*4
-            points, labels = room_data[:, 0:3], room_data[:, 3]  # xyz, N*3; l, N
             tmp, _ = np.histogram(labels, range(range_class))
             labelweights += tmp
-            coord_min, coord_max = np.amin(points, axis=0), np.amax(points, axis=0)
+            coord_min, coord_max = origin + np.amin(points, axis=0), origin + np.amax(points, axis=0)
             self.room_points.append(points)
+            self.room_origin.append(origin)
             self.room_labels.append(labels)
             self.room_coord_min.append(coord_min)
             self.room_coord_max.append(coord_max)
             num_point_all.append(labels.size)
 
+            # Index the room once so that block sampling does not scan every point
+            grid = GridIndex2D(points, block_size / 4.0)
+            self.room_grids.append(grid)
+            self.room_centres.append(block_centres(points, grid, block_size, room_path))
+
 
         sample_prob = num_point_all / np.sum(num_point_all)
         num_iter = int(np.sum(num_point_all) * sample_rate / num_point)
@@ -200,57 +220,26 @@ class TrainCustomDataset(Dataset): # Dataset class to extract point cloud model
         room_idx = self.room_idxs[idx]
         points = self.room_points[room_idx]  # N * 6
         labels = self.room_labels[room_idx]  # N
-        N_points = points.shape[0]
         extra_num = self.num_extra_features
 
-        while (True):
-            center = points[np.random.choice(N_points)][:3]
-            block_min = center - [self.block_size / 2.0, self.block_size / 2.0, 0]
-            block_max = center + [self.block_size / 2.0, self.block_size / 2.0, 0]
-            point_idxs = np.where((points[:, 0] >= block_min[0]) & (points[:, 0] <= block_max[0]) & (points[:, 1]
-                                                                                                     >= block_min[
-                                                                                                         1]) & (
-                                          points[:, 1] <= block_max[1]))[0]
-            if point_idxs.size > 1024:
-                break
+        centres = self.room_centres[room_idx]
+        center = points[np.random.choice(centres)][:3]
+        block_min = center - [self.block_size / 2.0, self.block_size / 2.0, 0]
+        block_max = center + [self.block_size / 2.0, self.block_size / 2.0, 0]
+        point_idxs = self.room_grids[room_idx].query(points, block_min, block_max)
 
         if point_idxs.size >= self.num_point:
             selected_point_idxs = np.random.choice(point_idxs, self.num_point, replace=False)
         else:
             selected_point_idxs = np.random.choice(point_idxs, self.num_point, replace=True)
 
-        # normalize
-        selected_points = points[selected_point_idxs, :]  # num_point * 6
-        current_points = np.zeros((self.num_point, 6))  # num_point * 6
-        current_points[:, 3] = selected_points[:, 0] / self.room_coord_max[room_idx][0]
-        current_points[:, 4] = selected_points[:, 1] / self.room_coord_max[room_idx][1]
-        current_points[:, 5] = selected_points[:, 2] / self.room_coord_max[room_idx][2]
-        selected_points[:, 0] = selected_points[:, 0] - center[0]
-        selected_points[:, 1] = selected_points[:, 1] - center[1]
-        current_points[:, 0:3] = selected_points
-
-        # Extra feature to be added
-        num_of_features = current_points.shape[1]
-        current_features = current_points
-
-        ex_features = []
-        for ix in range(extra_num):
-            tmp_feature_name = self.feature_name[ix]
-            features_room = self.extra_features_data[room_idx]
-            features_points = features_room[ix]
-            selected_feature = features_points[selected_point_idxs]  # num_point * lp_features
-            if tmp_feature_name == 'red' or tmp_feature_name == 'blue' or tmp_feature_name == 'green':
-                selected_feature = selected_feature/255
-            ex_features.append(selected_feature)
-            num_of_features += 1
-
-        tmp_np_features = np.zeros((self.num_point, num_of_features))
-        tmp_np_features[:, 0:current_points.shape[1]] = current_features
-        features_loop = num_of_features - current_points.shape[1]
-        for i in range(features_loop):
-            col_pointer = i + current_points.shape[1]
-            tmp_np_features[:, col_pointer] = ex_features[i]
-        current_features = tmp_np_features
+        # normalize, one gather of coordinates and features into the sample buffer
+        origin, coord_max = self.room_origin[room_idx], self.room_coord_max[room_idx]
+        features = self.extra_features_data[room_idx] if extra_num > 0 else None
+        current_features = np.empty((self.num_point, 6 + extra_num), dtype=FEATURE_DTYPE)
+        gather_sample(points, features, selected_point_idxs, origin / coord_max, 1.0 / coord_max, current_features)
+        current_features[:, 0] -= center[0]
+        current_features[:, 1] -= center[1]
 
         current_labels = labels[selected_point_idxs]
         if self.transform is not None:
@@ -286,6 +275,12 @@ class TrainCustomDataset(Dataset): # Dataset class to extract point cloud model
     def index_update(self, newIndices):  # adjust index
         self.room_idxs = newIndices
 
+    def add_features(self, names, columns): # append per-point columns given over all rooms concatenated
+        room_sizes = [len(points) for points in self.room_points]
+        self.extra_features_data = append_feature_columns(self.extra_features_data, columns, room_sizes)
+        self.feature_name = list(self.feature_name) + list(names)
+        self.num_extra_features += len(names)
+
     def copy(self, indices=None): # COPY EVERYTHING EXCEPT FOR INDEX
         copied_dataset = TrainCustomDataset()
         copied_dataset.num_point = self.num_point
@@ -296,6 +291,10 @@ class TrainCustomDataset(Dataset): # Dataset class to extract point cloud model
         copied_dataset.room_labels = self.room_labels.copy()
         copied_dataset.room_coord_min = self.room_coord_min.copy()
         copied_dataset.room_coord_max = self.room_coord_max.copy()
+        copied_dataset.room_origin = self.room_origin.copy()
+        copied_dataset.room_grids = self.room_grids.copy()
+        copied_dataset.room_centres = self.room_centres.copy()
+        copied_dataset.room_files = self.room_files.copy()
         copied_dataset.num_extra_features = self.num_extra_features
         copied_dataset.extra_features_data = self.extra_features_data
         copied_dataset.feature_name = self.feature_name
@@ -309,14 +308,60 @@ class TrainCustomDataset(Dataset): # Dataset class to extract point cloud model
         print("Totally {} samples in dataset.".format(len(copied_dataset.room_idxs)))
         return copied_dataset
 
-    def save_data(self, file_path): # Save extracted dataset
-        with open(file_path, 'wb') as f:
-            pickle.dump(self, f)
+    def save_data(self, file_path): # Save extracted dataset, one array file per attribute + manifest.json
+        attributes = {'num_point': self.num_point, 'block_size': self.block_size, 'num_classes': self.num_classes,
+                      'num_extra_features': self.num_extra_features, 'feature_name': list(self.feature_name),
+                      'room_files': list(self.room_files), 'non_index': [int(i) for i in self.non_index],
+                      'room_coord_min': [np.asarray(c).tolist() for c in self.room_coord_min],
+                      'room_coord_max': [np.asarray(c).tolist() for c in self.room_coord_max],
+                      'room_origin': [np.asarray(c).tolist() for c in self.room_origin]}
+        arrays = {'room_points': self.room_points,
+                  'room_labels': [np.asarray(labels, dtype=np.uint8) for labels in self.room_labels],
+                  'room_centres': self.room_centres,
+                  'room_idxs': [self.room_idxs]}
+        if self.num_extra_features > 0:
+            arrays['room_features'] = self.extra_features_data
+        save_columnar(file_path, attributes, arrays)
 
     @staticmethod
-    def load_data(file_path): # Load extracted dataset
-        with open(file_path, 'rb') as f:
-            dataset = pickle.load(f)
+    def load_data(file_path): # Load extracted dataset, memory-mapped
+        if not is_columnar(file_path):
+            with open(legacy_pickle_path(file_path), 'rb') as f: # Dataset pickled by an older version
+                dataset = pickle.load(f)
+            dataset.room_labels = [np.asarray(labels).astype(LABEL_DTYPE) for labels in dataset.room_labels]
+            if not hasattr(dataset, 'room_origin'): # absolute float64 coordinates
+                dataset.room_origin = [np.amin(points[:, :3], axis=0) for points in dataset.room_points]
+                dataset.room_points = [(points[:, :3] - origin).astype(np.float32)
+                                       for points, origin in zip(dataset.room_points, dataset.room_origin)]
+            if dataset.num_extra_features > 0 and isinstance(dataset.extra_features_data[0], list): # one array per feature
+                dataset.extra_features_data = [normalize_features(np.stack(features_room, axis=1).astype(np.float32),
+                                                                  dataset.feature_name)
+                                               for features_room in dataset.extra_features_data]
+            if not hasattr(dataset, 'room_grids'):
+                dataset.room_grids = [GridIndex2D(points, dataset.block_size / 4.0) for points in dataset.room_points]
+                room_names = getattr(dataset, 'room_files', ['room %d' % i for i in range(len(dataset.room_points))])
+                dataset.room_centres = [block_centres(points, grid, dataset.block_size, room_path)
+                                        for points, grid, room_path in zip(dataset.room_points, dataset.room_grids,
+                                                                           room_names)]
+        else:
+            attributes, arrays = load_columnar(file_path)
+            dataset = TrainCustomDataset()
+            dataset.num_point = attributes['num_point']
+            dataset.block_size = attributes['block_size']
+            dataset.num_classes = attributes['num_classes']
+            dataset.num_extra_features = attributes['num_extra_features']
+            dataset.feature_name = attributes['feature_name']
+            dataset.room_files = attributes['room_files']
+            dataset.non_index = attributes['non_index']
+            dataset.room_coord_min = [np.array(c) for c in attributes['room_coord_min']]
+            dataset.room_coord_max = [np.array(c) for c in attributes['room_coord_max']]
+            dataset.room_origin = [np.array(c) for c in attributes['room_origin']]
+            dataset.room_points = arrays['room_points']
+            dataset.room_labels = arrays['room_labels']
+            dataset.room_centres = arrays['room_centres']
+            dataset.room_idxs = np.array(arrays['room_idxs'][0])
+            dataset.extra_features_data = arrays.get('room_features', [])
+            dataset.room_grids = [GridIndex2D(points, dataset.block_size / 4.0) for points in dataset.room_points]
 
         print("Extra features to be included = %d" % dataset.num_extra_features)
         print("Number of Classes in dataset = %d" % dataset.num_classes)
@@ -331,7 +376,12 @@ def main(args):
 
     '''Initialize Variables'''
 
-    if args.class8 is False:
+    label_remap = None
+    if args.class_mapping is not None:
+        label_remap = LabelRemap.from_file(args.class_mapping)
+        NUM_CLASSES = label_remap.num_classes
+        classes = label_remap.classes if label_remap.classes is not None else ['class %d' % i for i in range(NUM_CLASSES)]
+    elif args.class8 is False:
         classes = classes_18
         NUM_CLASSES = NUM_CLASSES_18
     else:
@@ -364,6 +414,8 @@ def main(args):
 
     # Hyper Parameter
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    device = select_device(args.device, args.num_threads)
+    print("Device = %s" % device)
 
     '''CREATE DIR'''
     timestr = str(datetime.datetime.now().strftime('%Y-%m-%d_%H-%M'))
@@ -423,7 +475,8 @@ def main(args):
                 tmp_feature_list.remove('Surface variation')
 
         lidar_dataset = TrainCustomDataset(las_file_list, tmp_feature_list, num_classes=NUM_CLASSES, num_point=NUM_POINT,
-                                           transform=None, class8=args.class8)
+                                           transform=None, class8=args.class8, label_remap=label_remap,
+                                           coord_dtype=COORD_DTYPES[args.coord_dtype])
         print("Dataset taken")
 
         # Split the dataset into training and evaluation sets
@@ -441,18 +494,12 @@ def main(args):
             calTime = time.time()
             print("room_idx training")
             print(len(TRAIN_DATASET.room_idxs))
-            lp, lo, lc, non_index = cal_geofeature(TRAIN_DATASET, args.downsample, args.visualizeModel)
+            lp, lo, lc, non_index = cal_geofeature(TRAIN_DATASET, args.downsample, args.visualizeModel, args.geo_workers)
                         
             # Store the additional features in the CustomDataset instance
-            if 'Planarity' in feature_list:
-                TRAIN_DATASET.extra_features_data.append(lp)
-                TRAIN_DATASET.num_extra_features+=1
-            if 'Omnivariance' in feature_list:
-                TRAIN_DATASET.extra_features_data.append(lo)
-                TRAIN_DATASET.num_extra_features+=1
-            if 'Surface variation' in feature_list:
-                TRAIN_DATASET.extra_features_data.append(lc)
-                TRAIN_DATASET.num_extra_features+=1
+            geo_columns = {'Planarity': lp, 'Omnivariance': lo, 'Surface variation': lc}
+            geo_names = [name for name in geo_columns if name in args.extra_features]
+            TRAIN_DATASET.add_features(geo_names, [geo_columns[name] for name in geo_names])
             
             TRAIN_DATASET.non_index = non_index
             # Filter the points and labels using the non_index variable
@@ -466,18 +513,12 @@ def main(args):
 
             print("room_idx evaluation")
             print(len(EVAL_DATASET.room_idxs))
-            lp, lo, lc, non_index = cal_geofeature(EVAL_DATASET, args.downsample, args.visualizeModel)
+            lp, lo, lc, non_index = cal_geofeature(EVAL_DATASET, args.downsample, args.visualizeModel, args.geo_workers)
             
             # Store the additional features in the CustomDataset instance
-            if 'Planarity' in feature_list:
-                EVAL_DATASET.extra_features_data.append(lp)
-                EVAL_DATASET.num_extra_features+=1
-            if 'Omnivariance' in feature_list:
-                EVAL_DATASET.extra_features_data.append(lo)
-                EVAL_DATASET.num_extra_features+=1
-            if 'Surface variation' in feature_list:
-                EVAL_DATASET.extra_features_data.append(lc)
-                EVAL_DATASET.num_extra_features+=1
+            geo_columns = {'Planarity': lp, 'Omnivariance': lo, 'Surface variation': lc}
+            geo_names = [name for name in geo_columns if name in args.extra_features]
+            EVAL_DATASET.add_features(geo_names, [geo_columns[name] for name in geo_names])
             
             EVAL_DATASET.non_index = non_index
             # Filter the points and labels using the non_index variable
@@ -512,33 +553,46 @@ def main(args):
         timePrint(savetime)
         CurrentTime(timezone)
 
-    trainDataLoader = DataLoader(TRAIN_DATASET, batch_size=BATCH_SIZE, shuffle=True, num_workers=8,
-                                 pin_memory=True, drop_last=True,
-                                 worker_init_fn=lambda x: np.random.seed(x + int(time.time())))
-    evalDataLoader = DataLoader(EVAL_DATASET, batch_size=BATCH_SIZE, shuffle=False, num_workers=8,
-                                pin_memory=True, drop_last=True)
-
     log_string("The number of training data is: %d" % len(TRAIN_DATASET))
     print("wall", "window", "door", "molding", "other", "terrain", "column", "arch") # Adjust according to dataset
     train_labelweights = TRAIN_DATASET.calculate_labelweights()
     log_string("The number of eval data is: %d" % len(EVAL_DATASET))
     print("wall", "window", "door", "molding", "other", "terrain", "column", "arch") # Adjust according to dataset
     eval_labelweights = EVAL_DATASET.calculate_labelweights()
-    train_weights = torch.Tensor(train_labelweights).cuda()
-
-    print("Length of the trainDataLoader:", len(trainDataLoader))
+    train_weights = torch.tensor(train_labelweights, dtype=torch.float32, device=device)
 
     '''MODEL LOADING'''
     MODEL = importlib.import_module(args.model)
+    set_fps_backend(args.fps)
     shutil.copy('models/%s.py' % args.model, str(experiment_dir))
     shutil.copy('models/pointnet2_utils.py', str(experiment_dir))
 
     num_extra_features = TRAIN_DATASET.num_extra_features
     print("number = %d" % num_extra_features)
 
-    classifier = MODEL.get_model(NUM_CLASSES, num_extra_features).cuda()  # name sensitive but not case sensitive
-    criterion = MODEL.get_loss().cuda()
+    classifier = MODEL.get_model(NUM_CLASSES, num_extra_features).to(device)  # name sensitive but not case sensitive
+    criterion = MODEL.get_loss(ignore_index=IGNORE_LABEL).to(device)
     classifier.apply(inplace_relu)
+    if args.channels_last is True:
+        classifier = classifier.to(memory_format=torch.channels_last)
+
+    # Sampling and grouping indices computed by the DataLoader workers, only valid under rigid augmentation
+    augment = build_augmentation(args.augment)
+    collate_fn = None
+    if args.precompute_geometry is True:
+        if not hasattr(classifier, 'geometry_levels'):
+            log_string('Model %s does not take a geometry context, computing it in the forward pass' % args.model)
+        elif not augment.rigid:
+            log_string('Augmentation %s is not rigid, computing geometry in the forward pass' % args.augment)
+        else:
+            collate_fn = GeometryCollate(classifier.geometry_levels())
+
+    trainDataLoader = DataLoader(TRAIN_DATASET, batch_size=BATCH_SIZE, shuffle=True, num_workers=8,
+                                 pin_memory=device.type == 'cuda', drop_last=True, collate_fn=collate_fn,
+                                 worker_init_fn=lambda x: np.random.seed(x + int(time.time())))
+    evalDataLoader = DataLoader(EVAL_DATASET, batch_size=BATCH_SIZE, shuffle=False, num_workers=8,
+                                pin_memory=device.type == 'cuda', drop_last=True, collate_fn=collate_fn)
+    print("Length of the trainDataLoader:", len(trainDataLoader))
 
     def weights_init(m):
         classname = m.__class__.__name__
@@ -553,7 +607,7 @@ def main(args):
 
     # Check if model used has been trained on similar dataset before, else start new
     try:
-        checkpoint = torch.load(str(experiment_dir) + '/checkpoints' + model_name)
+        checkpoint = torch.load(str(experiment_dir) + '/checkpoints' + model_name, map_location=device)
         start_epoch = checkpoint['epoch']
         classifier.load_state_dict(checkpoint['model_state_dict'])
         log_string('Use pretrain model')
@@ -590,7 +644,7 @@ def main(args):
     accuracyChart, MLChart, IoUChart =  modelTraining(start_epoch, args.epoch, args.learning_rate, args.lr_decay, args.step_size,
                                         BATCH_SIZE, NUM_POINT, NUM_CLASSES, trainDataLoader, evalDataLoader, classifier,
                                         optimizer, criterion, train_weights, checkpoints_dir, model_name, seg_label_to_cat,
-                                        logger)
+                                        logger, augment, args.amp, args.prefetch)
 
     return accuracyChart, MLChart, IoUChart
 
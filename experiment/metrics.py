@@ -0,0 +1,110 @@
+import numpy as np
+import torch
+
+''' Segmentation metrics from a streaming confusion matrix, shared by training evaluation and whole-scene testing.
+    Every update is one index_add_ into the fixed size counts, on the device of the matrix. Unlike bincount,
+    which reads the input range back to size its output, it does not synchronise the training loop with the host.
+    Metrics are computed from a single host copy of the matrix.
+    Rows are ground truth classes, columns predicted classes; labels outside [0, num_classes) are ignored.
+'''
+
+
+class ConfusionMatrix():
+    """ num_classes x num_classes confusion matrix accumulated with index_add_
+        Input:
+            num_classes: number of classes
+            device: device of the counts, cpu when None
+    """
+    eps = 1e-6
+
+    def __init__(self, num_classes, device=None):
+        self.num_classes = num_classes
+        # One extra bin collects ignored labels, so no boolean indexing (and no sync) is needed
+        self.counts = torch.zeros(num_classes * num_classes + 1, dtype=torch.long, device=device)
+        self._host = None
+
+    @property
+    def device(self):
+        return self.counts.device
+
+    def reset(self):
+        self.counts.zero_()
+        self._host = None
+        return self
+
+    def update(self, pred, target):
+        """ Add predictions and ground truth of any shape, torch tensors or numpy arrays """
+        C = self.num_classes
+        # NumPy inputs, e.g. read-only memory-mapped labels, are cast to a new int64 array first
+        if isinstance(pred, np.ndarray):
+            pred = pred.astype(np.int64)
+        if isinstance(target, np.ndarray):
+            target = target.astype(np.int64)
+        pred = torch.as_tensor(pred, device=self.device).reshape(-1).long()
+        target = torch.as_tensor(target, device=self.device).reshape(-1).long()
+        valid = (target >= 0) & (target < C) & (pred >= 0) & (pred < C)
+        index = torch.where(valid, target * C + pred, torch.full_like(target, C * C))
+        self.counts.index_add_(0, index, torch.ones_like(index))
+        self._host = None
+        return self
+
+    def merge(self, other):
+        """ Add the counts of another partial result, e.g. of one scene to the whole test set """
+        assert other.num_classes == self.num_classes
+        self.counts += other.counts.to(self.device)
+        self._host = None
+        return self
+
+    def value(self):
+        """ Host copy of the CxC matrix, int64 """
+        if self._host is None:
+            self._host = self.counts[:-1].view(self.num_classes, self.num_classes).cpu().numpy()
+        return self._host
+
+    def seen(self):
+        # ground truth points per class
+        return self.value().sum(axis=1)
+
+    def predicted(self):
+        return self.value().sum(axis=0)
+
+    def correct(self):
+        return np.diag(self.value())
+
+    def total(self):
+        return int(self.value().sum())
+
+    def overall_accuracy(self):
+        return np.sum(self.correct()) / (float(self.total()) + self.eps)
+
+    def recall(self):
+        # per class accuracy
+        return self.correct() / (self.seen() + self.eps)
+
+    def precision(self):
+        return self.correct() / (self.predicted() + self.eps)
+
+    def f1(self):
+        precision, recall = self.precision(), self.recall()
+        return 2 * precision * recall / (precision + recall + self.eps)
+
+    def iou_denominator(self):
+        return self.seen() + self.predicted() - self.correct()
+
+    def iou(self):
+        return self.correct() / (self.iou_denominator() + self.eps)
+
+    def mean_accuracy(self):
+        return np.mean(self.recall())
+
+    def mean_iou(self, present_only=False):
+        """ present_only: average over the classes with ground truth points only """
+        iou = self.iou()
+        if present_only:
+            iou = iou[self.seen() != 0]
+        return np.mean(iou)
+
+    def label_weights(self):
+        # ground truth class frequencies
+        seen = self.seen().astype(np.float32)
+        return seen / max(np.sum(seen), 1)
@@ -1,6 +1,6 @@
 import torch.nn as nn
 import torch.nn.functional as F
-from models.pointnet2_utils import PointNetSetAbstraction,PointNetFeaturePropagation
+from models.pointnet2_utils import PointNetSetAbstraction,PointNetFeaturePropagation,GeometryContext
 
 
 class get_model(nn.Module):
@@ -19,19 +19,29 @@ class get_model(nn.Module):
         self.drop1 = nn.Dropout(0.5)
         self.conv2 = nn.Conv1d(128, num_classes, 1)
 
-    def forward(self, xyz):
+    def geometry_levels(self):
+        return [(sa.npoint, sa.radius, sa.nsample) for sa in [self.sa1, self.sa2, self.sa3, self.sa4]]
+
+    def build_geometry(self, xyz):
+        # xyz: [B, C, N] network input, only the first three channels are used
+        return GeometryContext.build(xyz[:, :3, :].permute(0, 2, 1), self.geometry_levels())
+
+    def forward(self, xyz, geometry=None):
+        if geometry is None:
+            geometry = self.build_geometry(xyz)
         l0_points = xyz
         l0_xyz = xyz[:,:3,:]
+        fps_idx, group_idx, interpolation = geometry.fps_idx, geometry.group_idx, geometry.interpolation
 
-        l1_xyz, l1_points = self.sa1(l0_xyz, l0_points)
-        l2_xyz, l2_points = self.sa2(l1_xyz, l1_points)
-        l3_xyz, l3_points = self.sa3(l2_xyz, l2_points)
-        l4_xyz, l4_points = self.sa4(l3_xyz, l3_points)
+        l1_xyz, l1_points = self.sa1(l0_xyz, l0_points, fps_idx[0], group_idx[0])
+        l2_xyz, l2_points = self.sa2(l1_xyz, l1_points, fps_idx[1], group_idx[1])
+        l3_xyz, l3_points = self.sa3(l2_xyz, l2_points, fps_idx[2], group_idx[2])
+        l4_xyz, l4_points = self.sa4(l3_xyz, l3_points, fps_idx[3], group_idx[3])
 
-        l3_points = self.fp4(l3_xyz, l4_xyz, l3_points, l4_points)
-        l2_points = self.fp3(l2_xyz, l3_xyz, l2_points, l3_points)
-        l1_points = self.fp2(l1_xyz, l2_xyz, l1_points, l2_points)
-        l0_points = self.fp1(l0_xyz, l1_xyz, None, l1_points)
+        l3_points = self.fp4(l3_xyz, l4_xyz, l3_points, l4_points, interpolation[3])
+        l2_points = self.fp3(l2_xyz, l3_xyz, l2_points, l3_points, interpolation[2])
+        l1_points = self.fp2(l1_xyz, l2_xyz, l1_points, l2_points, interpolation[1])
+        l0_points = self.fp1(l0_xyz, l1_xyz, None, l1_points, interpolation[0])
 
         x = self.drop1(F.relu(self.bn1(self.conv1(l0_points))))
         x = self.conv2(x)
@@ -42,10 +52,12 @@ class get_model(nn.Module):
 
 
 class get_loss(nn.Module):
-    def __init__(self):
+    # ignore_index: unmapped label (localfunctions.IGNORE_LABEL), left out of the loss
+    def __init__(self, ignore_index=255):
         super(get_loss, self).__init__()
+        self.ignore_index = ignore_index
     def forward(self, pred, target, trans_feat, weight):
-        total_loss = F.nll_loss(pred, target, weight=weight)
+        total_loss = F.nll_loss(pred, target, weight=weight, ignore_index=self.ignore_index)
 
         return total_loss
 
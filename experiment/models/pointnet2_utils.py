@@ -26,6 +26,8 @@ def square_distance(src, dst):
     dist = (xn - xm)^2 + (yn - ym)^2 + (zn - zm)^2
          = sum(src**2,dim=-1)+sum(dst**2,dim=-1)-2*src^T*dst
 
+    Always computed in fp32, also under autocast, so that ball queries and interpolation stay exact
+
     Input:
         src: source points, [B, N, C]
         dst: target points, [B, M, C]
@@ -34,9 +36,11 @@ def square_distance(src, dst):
     """
     B, N, _ = src.shape
     _, M, _ = dst.shape
-    dist = -2 * torch.matmul(src, dst.permute(0, 2, 1))
-    dist += torch.sum(src ** 2, -1).view(B, N, 1)
-    dist += torch.sum(dst ** 2, -1).view(B, 1, M)
+    with torch.autocast(device_type=src.device.type, enabled=False):
+        src, dst = src.float(), dst.float()
+        dist = -2 * torch.matmul(src, dst.permute(0, 2, 1))
+        dist += torch.sum(src ** 2, -1).view(B, N, 1)
+        dist += torch.sum(dst ** 2, -1).view(B, 1, M)
     return dist
 
 
@@ -60,54 +64,210 @@ def index_points(points, idx):
     return new_points
 
 
-def farthest_point_sample(xyz, npoint):
+# Farthest point sampling backend: 'auto' (numpy on CPU, torch otherwise), 'torch', 'numpy' or 'approx'
+FPS_BACKENDS = ['auto', 'torch', 'numpy', 'approx']
+FPS_BACKEND = 'auto'
+# Voxel size of the approximate backend, one random candidate point per voxel
+FPS_VOXEL_SIZE = 0.05
+
+
+def set_fps_backend(backend, voxel_size=None):
+    global FPS_BACKEND, FPS_VOXEL_SIZE
+    if backend not in FPS_BACKENDS:
+        raise ValueError('Unknown FPS backend %s, choose from %s' % (backend, ', '.join(FPS_BACKENDS)))
+    FPS_BACKEND = backend
+    if voxel_size is not None:
+        FPS_VOXEL_SIZE = voxel_size
+
+
+def farthest_point_sample(xyz, npoint, backend=None):
     """
     Input:
         xyz: pointcloud data, [B, N, 3]
         npoint: number of samples
+        backend: one of FPS_BACKENDS, default FPS_BACKEND
+    Return:
+        centroids: sampled pointcloud index, [B, npoint]
+    """
+    backend = FPS_BACKEND if backend is None else backend
+    if backend == 'auto':
+        backend = 'numpy' if xyz.device.type == 'cpu' else 'torch'
+    if backend == 'torch':
+        return farthest_point_sample_torch(xyz, npoint)
+    if backend == 'numpy':
+        return farthest_point_sample_numpy(xyz, npoint)
+    if backend == 'approx':
+        return farthest_point_sample_approx(xyz, npoint)
+    raise ValueError('Unknown FPS backend %s, choose from %s' % (backend, ', '.join(FPS_BACKENDS)))
+
+
+def farthest_point_sample_torch(xyz, npoint, start=None):
+    """
+    Exact FPS on the tensor's device, running minimum with torch.minimum instead of mask assignment
+    Input:
+        xyz: pointcloud data, [B, N, 3]
+        npoint: number of samples
+        start: first sample of every cloud, [B], random by default
     Return:
         centroids: sampled pointcloud index, [B, npoint]
     """
     device = xyz.device
     B, N, C = xyz.shape
-    centroids = torch.zeros(B, npoint, dtype=torch.long).to(device)
-    distance = torch.ones(B, N).to(device) * 1e10
-    farthest = torch.randint(0, N, (B,), dtype=torch.long).to(device)
-    batch_indices = torch.arange(B, dtype=torch.long).to(device)
+    centroids = torch.zeros(B, npoint, dtype=torch.long, device=device)
+    distance = torch.full((B, N), 1e10, dtype=xyz.dtype, device=device)
+    farthest = torch.randint(0, N, (B,), dtype=torch.long).to(device) if start is None else start
+    batch_indices = torch.arange(B, dtype=torch.long, device=device)
     for i in range(npoint):
         centroids[:, i] = farthest
         centroid = xyz[batch_indices, farthest, :].view(B, 1, 3)
         dist = torch.sum((xyz - centroid) ** 2, -1)
-        mask = dist < distance
-        distance[mask] = dist[mask]
+        distance = torch.minimum(distance, dist)
         farthest = torch.max(distance, -1)[1]
     return centroids
 
 
-def query_ball_point(radius, nsample, xyz, new_xyz):
+def farthest_point_sample_numpy(xyz, npoint, start=None):
+    """
+    Exact FPS in NumPy for CPU tensors, one coordinate array per axis and preallocated buffers
+    so that every iteration is a handful of in-place vector operations
+    Input:
+        xyz: pointcloud data, [B, N, 3]
+        npoint: number of samples
+        start: first sample of every cloud, [B], random by default
+    Return:
+        centroids: sampled pointcloud index, [B, npoint]
+    """
+    device = xyz.device
+    B, N, C = xyz.shape
+    farthest = torch.randint(0, N, (B,), dtype=torch.long) if start is None else start.cpu()
+    farthest = farthest.numpy().copy()
+    points = xyz.detach().cpu().numpy()
+    x, y, z = [np.ascontiguousarray(points[:, :, c]) for c in range(3)]
+    centroids = np.zeros((B, npoint), dtype=np.int64)
+    distance = np.full((B, N), 1e10, dtype=points.dtype)
+    dist = np.empty((B, N), dtype=points.dtype)
+    tmp = np.empty((B, N), dtype=points.dtype)
+    batch_indices = np.arange(B)
+    for i in range(npoint):
+        centroids[:, i] = farthest
+        np.subtract(x, x[batch_indices, farthest][:, np.newaxis], out=dist)
+        np.multiply(dist, dist, out=dist)
+        np.subtract(y, y[batch_indices, farthest][:, np.newaxis], out=tmp)
+        np.multiply(tmp, tmp, out=tmp)
+        dist += tmp
+        np.subtract(z, z[batch_indices, farthest][:, np.newaxis], out=tmp)
+        np.multiply(tmp, tmp, out=tmp)
+        dist += tmp
+        np.minimum(distance, dist, out=distance)
+        farthest = np.argmax(distance, axis=1)
+    return torch.from_numpy(centroids).to(device)
+
+
+def farthest_point_sample_approx(xyz, npoint, voxel_size=None):
+    """
+    Approximate FPS: one random point per occupied voxel is kept as candidate, exact FPS runs
+    on the candidates only. Clouds with fewer occupied voxels than npoint are topped up with random points.
+    Input:
+        xyz: pointcloud data, [B, N, 3]
+        npoint: number of samples
+        voxel_size: voxel edge length, default FPS_VOXEL_SIZE
+    Return:
+        centroids: sampled pointcloud index, [B, npoint]
+    """
+    device = xyz.device
+    B, N, C = xyz.shape
+    voxel_size = FPS_VOXEL_SIZE if voxel_size is None else voxel_size
+    backend = 'numpy' if device.type == 'cpu' else 'torch'
+    centroids = torch.zeros(B, npoint, dtype=torch.long, device=device)
+    for b in range(B):
+        points = xyz[b]
+        voxel = torch.floor((points - points.min(0)[0]) / voxel_size).long()
+        dims = voxel.max(0)[0] + 1
+        key = (voxel[:, 0] * dims[1] + voxel[:, 1]) * dims[2] + voxel[:, 2]
+        perm = torch.randperm(N, device=device)
+        sorted_key, order = torch.sort(key[perm], stable=True)
+        first = torch.ones(N, dtype=torch.bool, device=device)
+        first[1:] = sorted_key[1:] != sorted_key[:-1]
+        candidates = perm[order[first]]
+        if candidates.numel() < npoint:
+            rest = torch.ones(N, dtype=torch.bool, device=device)
+            rest[candidates] = False
+            rest = torch.nonzero(rest).view(-1)
+            rest = rest[torch.randperm(rest.numel(), device=device)[:npoint - candidates.numel()]]
+            candidates = torch.cat([candidates, rest])
+        sampled = farthest_point_sample(points[candidates].view(1, -1, C), npoint, backend)
+        centroids[b] = candidates[sampled[0]]
+    return centroids
+
+
+# Largest B x chunk x N distance block query_ball_point holds at once
+BALL_QUERY_MAX_ELEMENTS = 2 ** 25
+
+
+def query_ball_point(radius, nsample, xyz, new_xyz, chunk_size=None):
     """
     Input:
         radius: local region radius
         nsample: max sample number in local region
         xyz: all points, [B, N, 3]
         new_xyz: query points, [B, S, 3]
+        chunk_size: query points handled at once, default keeps B x chunk x N under BALL_QUERY_MAX_ELEMENTS
     Return:
         group_idx: grouped points index, [B, S, nsample]
     """
     device = xyz.device
     B, N, C = xyz.shape
     _, S, _ = new_xyz.shape
-    group_idx = torch.arange(N, dtype=torch.long).to(device).view(1, 1, N).repeat([B, S, 1])
-    sqrdists = square_distance(new_xyz, xyz)
-    group_idx[sqrdists > radius ** 2] = N
-    group_idx = group_idx.sort(dim=-1)[0][:, :, :nsample]
-    group_first = group_idx[:, :, 0].view(B, S, 1).repeat([1, 1, nsample])
+    if chunk_size is None:
+        chunk_size = max(1, BALL_QUERY_MAX_ELEMENTS // (B * N))
+    k = min(nsample, N)
+    point_idx = torch.arange(N, dtype=torch.long, device=device).view(1, 1, N)
+    group_idx = torch.empty(B, S, nsample, dtype=torch.long, device=device)
+    for start in range(0, S, chunk_size):
+        end = min(start + chunk_size, S)
+        sqrdists = square_distance(new_xyz[:, start:end, :], xyz)
+        # The k smallest indices inside the radius, in ascending order, without sorting all N
+        candidates = torch.where(sqrdists > radius ** 2, N, point_idx)
+        group_idx[:, start:end, :k] = candidates.topk(k, dim=-1, largest=False, sorted=True)[0]
+    group_first = group_idx[:, :, 0:1].expand(B, S, nsample)
+    if k < nsample:
+        group_idx[:, :, k:] = N
     mask = group_idx == N
     group_idx[mask] = group_first[mask]
     return group_idx
 
 
-def sample_and_group(npoint, radius, nsample, xyz, points, returnfps=False):
+def three_nn_interpolation(xyz1, xyz2, chunk_size=None):
+    """
+    Inverse distance weights of the 3 nearest sampled points, topk over chunks of xyz1 instead of a full sort
+    Input:
+        xyz1: input points position data, [B, N, C]
+        xyz2: sampled input points position data, [B, S, C]
+        chunk_size: points of xyz1 handled at once, default keeps B x chunk x S under BALL_QUERY_MAX_ELEMENTS
+    Return:
+        idx: nearest sampled points index, [B, N, 3]
+        weight: interpolation weights, [B, N, 3]
+    """
+    device = xyz1.device
+    B, N, C = xyz1.shape
+    _, S, _ = xyz2.shape
+    if chunk_size is None:
+        chunk_size = max(1, BALL_QUERY_MAX_ELEMENTS // (B * S))
+    k = min(3, S)
+    dists = torch.empty(B, N, k, dtype=xyz1.dtype, device=device)
+    idx = torch.empty(B, N, k, dtype=torch.long, device=device)
+    for start in range(0, N, chunk_size):
+        end = min(start + chunk_size, N)
+        sqrdists = square_distance(xyz1[:, start:end, :], xyz2)
+        dists[:, start:end], idx[:, start:end] = sqrdists.topk(k, dim=-1, largest=False, sorted=True)
+
+    dist_recip = 1.0 / (dists + 1e-8)
+    norm = torch.sum(dist_recip, dim=2, keepdim=True)
+    weight = dist_recip / norm
+    return idx, weight
+
+
+def sample_and_group(npoint, radius, nsample, xyz, points, returnfps=False, fps_idx=None, idx=None):
     """
     Input:
         npoint:
@@ -115,15 +275,19 @@ def sample_and_group(npoint, radius, nsample, xyz, points, returnfps=False):
         nsample:
         xyz: input points position data, [B, N, 3]
         points: input points data, [B, N, D]
+        fps_idx: optional precomputed sampling index, [B, npoint]
+        idx: optional precomputed grouping index, [B, npoint, nsample]
     Return:
         new_xyz: sampled points position data, [B, npoint, nsample, 3]
         new_points: sampled points data, [B, npoint, nsample, 3+D]
     """
     B, N, C = xyz.shape
     S = npoint
-    fps_idx = farthest_point_sample(xyz, npoint) # [B, npoint, C]
+    if fps_idx is None:
+        fps_idx = farthest_point_sample(xyz, npoint) # [B, npoint, C]
     new_xyz = index_points(xyz, fps_idx)
-    idx = query_ball_point(radius, nsample, xyz, new_xyz)
+    if idx is None:
+        idx = query_ball_point(radius, nsample, xyz, new_xyz)
     grouped_xyz = index_points(xyz, idx) # [B, npoint, nsample, C]
     grouped_xyz_norm = grouped_xyz - new_xyz.view(B, S, 1, C)
 
@@ -158,6 +322,63 @@ def sample_and_group_all(xyz, points):
     return new_xyz, new_points
 
 
+class GeometryContext():
+    """
+    Sampling, grouping and interpolation indices of every level of the network. They depend on xyz only,
+    so they can be computed ahead of the forward, e.g. in DataLoader workers, and passed to every level.
+    The ball query and the 3-NN interpolation of a level still compute their own distance block: one shared
+    block needs a top-k along its strided dimension, which measured slower than the second matmul.
+        xyz: points position data of every level, [B, N_l, 3], level 0 is the input
+        fps_idx: sampling index of level l + 1 in level l, [B, S_l]
+        group_idx: ball query index of level l + 1 in level l, [B, S_l, K_l]
+        interpolation: (idx, weight) of level l from level l + 1, [B, N_l, 3] each
+    """
+    def __init__(self, xyz, fps_idx, group_idx, interpolation):
+        self.xyz = xyz
+        self.fps_idx = fps_idx
+        self.group_idx = group_idx
+        self.interpolation = interpolation
+
+    @staticmethod
+    def build(xyz, levels):
+        """
+        Input:
+            xyz: input points position data, [B, N, 3]
+            levels: (npoint, radius, nsample) of every set abstraction level
+        Return:
+            GeometryContext
+        """
+        level_xyz, fps_list, group_list, interpolation_list = [xyz], [], [], []
+        for npoint, radius, nsample in levels:
+            fps_idx = farthest_point_sample(xyz, npoint)
+            new_xyz = index_points(xyz, fps_idx)
+            fps_list.append(fps_idx)
+            group_list.append(query_ball_point(radius, nsample, xyz, new_xyz))
+            interpolation_list.append(three_nn_interpolation(xyz, new_xyz) if npoint > 1 else None)
+            level_xyz.append(new_xyz)
+            xyz = new_xyz
+        return GeometryContext(level_xyz, fps_list, group_list, interpolation_list)
+
+    def apply(self, fn):
+        # New context with fn applied to every tensor
+        interpolation = [None if pair is None else (fn(pair[0]), fn(pair[1])) for pair in self.interpolation]
+        return GeometryContext([fn(t) for t in self.xyz], [fn(t) for t in self.fps_idx],
+                               [fn(t) for t in self.group_idx], interpolation)
+
+    def to(self, device, non_blocking=False):
+        return self.apply(lambda t: t.to(device, non_blocking=non_blocking))
+
+    def pin_memory(self):
+        # Called by the DataLoader with pin_memory=True, so the copy to the GPU can be asynchronous
+        return self.apply(lambda t: t.pin_memory())
+
+    def record_stream(self, stream):
+        # Mark the tensors as used on stream, when they were copied to the GPU on another stream
+        pairs = [t for pair in self.interpolation if pair is not None for t in pair]
+        for t in self.xyz + self.fps_idx + self.group_idx + pairs:
+            t.record_stream(stream)
+
+
 class PointNetSetAbstraction(nn.Module):
     def __init__(self, npoint, radius, nsample, in_channel, mlp, group_all):
         super(PointNetSetAbstraction, self).__init__()
@@ -173,11 +394,13 @@ class PointNetSetAbstraction(nn.Module):
             last_channel = out_channel
         self.group_all = group_all
 
-    def forward(self, xyz, points):
+    def forward(self, xyz, points, fps_idx=None, group_idx=None):
         """
         Input:
             xyz: input points position data, [B, C, N]
             points: input points data, [B, D, N]
+            fps_idx: optional precomputed sampling index, [B, S]
+            group_idx: optional precomputed grouping index, [B, S, nsample]
         Return:
             new_xyz: sampled points position data, [B, C, S]
             new_points_concat: sample points feature data, [B, D', S]
@@ -189,15 +412,17 @@ class PointNetSetAbstraction(nn.Module):
         if self.group_all:
             new_xyz, new_points = sample_and_group_all(xyz, points)
         else:
-            new_xyz, new_points = sample_and_group(self.npoint, self.radius, self.nsample, xyz, points)
+            new_xyz, new_points = sample_and_group(self.npoint, self.radius, self.nsample, xyz, points,
+                                                   fps_idx=fps_idx, idx=group_idx)
         # new_xyz: sampled points position data, [B, npoint, C]
         # new_points: sampled points data, [B, npoint, nsample, C+D]
-        new_points = new_points.permute(0, 3, 2, 1) # [B, C+D, nsample,npoint]
+        # [B, C+D, npoint, nsample], a view that is already contiguous in channels-last order
+        new_points = new_points.permute(0, 3, 1, 2)
         for i, conv in enumerate(self.mlp_convs):
             bn = self.mlp_bns[i]
             new_points =  F.relu(bn(conv(new_points)))
 
-        new_points = torch.max(new_points, 2)[0]
+        new_points = torch.max(new_points, 3)[0]
         new_xyz = new_xyz.permute(0, 2, 1)
         return new_xyz, new_points
 
@@ -221,11 +446,13 @@ class PointNetSetAbstractionMsg(nn.Module):
             self.conv_blocks.append(convs)
             self.bn_blocks.append(bns)
 
-    def forward(self, xyz, points):
+    def forward(self, xyz, points, fps_idx=None, group_idx_list=None):
         """
         Input:
             xyz: input points position data, [B, C, N]
             points: input points data, [B, D, N]
+            fps_idx: optional precomputed sampling index, [B, S]
+            group_idx_list: optional precomputed grouping index of every radius, [B, S, K_i]
         Return:
             new_xyz: sampled points position data, [B, C, S]
             new_points_concat: sample points feature data, [B, D', S]
@@ -236,11 +463,16 @@ class PointNetSetAbstractionMsg(nn.Module):
 
         B, N, C = xyz.shape
         S = self.npoint
-        new_xyz = index_points(xyz, farthest_point_sample(xyz, S))
+        if fps_idx is None:
+            fps_idx = farthest_point_sample(xyz, S)
+        new_xyz = index_points(xyz, fps_idx)
         new_points_list = []
         for i, radius in enumerate(self.radius_list):
             K = self.nsample_list[i]
-            group_idx = query_ball_point(radius, K, xyz, new_xyz)
+            if group_idx_list is None:
+                group_idx = query_ball_point(radius, K, xyz, new_xyz)
+            else:
+                group_idx = group_idx_list[i]
             grouped_xyz = index_points(xyz, group_idx)
             grouped_xyz -= new_xyz.view(B, S, 1, C)
             if points is not None:
@@ -249,12 +481,12 @@ class PointNetSetAbstractionMsg(nn.Module):
             else:
                 grouped_points = grouped_xyz
 
-            grouped_points = grouped_points.permute(0, 3, 2, 1)  # [B, D, K, S]
+            grouped_points = grouped_points.permute(0, 3, 1, 2)  # [B, D, S, K], channels-last view
             for j in range(len(self.conv_blocks[i])):
                 conv = self.conv_blocks[i][j]
                 bn = self.bn_blocks[i][j]
                 grouped_points =  F.relu(bn(conv(grouped_points)))
-            new_points = torch.max(grouped_points, 2)[0]  # [B, D', S]
+            new_points = torch.max(grouped_points, 3)[0]  # [B, D', S]
             new_points_list.append(new_points)
 
         new_xyz = new_xyz.permute(0, 2, 1)
@@ -273,13 +505,14 @@ class PointNetFeaturePropagation(nn.Module):
             self.mlp_bns.append(nn.BatchNorm1d(out_channel))
             last_channel = out_channel
 
-    def forward(self, xyz1, xyz2, points1, points2):
+    def forward(self, xyz1, xyz2, points1, points2, interpolation=None):
         """
         Input:
             xyz1: input points position data, [B, C, N]
             xyz2: sampled input points position data, [B, C, S]
             points1: input points data, [B, D, N]
             points2: input points data, [B, D, S]
+            interpolation: optional precomputed (idx, weight) from three_nn_interpolation, [B, N, 3] each
         Return:
             new_points: upsampled points data, [B, D', N]
         """
@@ -293,14 +526,10 @@ class PointNetFeaturePropagation(nn.Module):
         if S == 1:
             interpolated_points = points2.repeat(1, N, 1)
         else:
-            dists = square_distance(xyz1, xyz2)
-            dists, idx = dists.sort(dim=-1)
-            dists, idx = dists[:, :, :3], idx[:, :, :3]  # [B, N, 3]
-
-            dist_recip = 1.0 / (dists + 1e-8)
-            norm = torch.sum(dist_recip, dim=2, keepdim=True)
-            weight = dist_recip / norm
-            interpolated_points = torch.sum(index_points(points2, idx) * weight.view(B, N, 3, 1), dim=2)
+            if interpolation is None:
+                interpolation = three_nn_interpolation(xyz1, xyz2)
+            idx, weight = interpolation  # [B, N, 3]
+            interpolated_points = torch.sum(index_points(points2, idx) * weight.unsqueeze(-1), dim=2)
 
         if points1 is not None:
             points1 = points1.permute(0, 2, 1)
@@ -34,12 +34,13 @@ class get_model(nn.Module):
         return x, trans_feat
 
 class get_loss(torch.nn.Module):
-    def __init__(self, mat_diff_loss_scale=0.001):
+    def __init__(self, mat_diff_loss_scale=0.001, ignore_index=255):
         super(get_loss, self).__init__()
         self.mat_diff_loss_scale = mat_diff_loss_scale
+        self.ignore_index = ignore_index
 
     def forward(self, pred, target, trans_feat, weight):
-        loss = F.nll_loss(pred, target, weight = weight)
+        loss = F.nll_loss(pred, target, weight = weight, ignore_index=self.ignore_index)
         mat_diff_loss = feature_transform_reguliarzer(trans_feat)
         total_loss = loss + mat_diff_loss * self.mat_diff_loss_scale
         return total_loss
@@ -0,0 +1,131 @@
+import numpy as np
+import laspy
+
+''' Output stage of whole-scene testing. Every format is written with whole-array calls:
+    npy (default): predicted labels, uint8, plus the vote confidences in <scene>_confidence.npy
+    txt: one predicted label per line, as the former output
+    las / laz: copy of the input file with pred, gt and confidence extra dimensions (laz needs lazrs or laszip)
+    obj / ply: <scene>_pred and <scene>_gt point clouds coloured through a label -> colour lookup table
+'''
+
+OUTPUT_FORMATS = ['npy', 'txt', 'las', 'laz', 'obj', 'ply']
+
+# Rows formatted by one string operation when writing OBJ files
+OBJ_CHUNK_SIZE = 100000
+
+
+def label_color_lut(label2color, default=(0, 0, 0)):
+    """ 256x3 uint8 lookup table from a {label: [r, g, b]} dict, labels without colour get default """
+    lut = np.empty((256, 3), dtype=np.uint8)
+    lut[:] = default
+    for label, color in label2color.items():
+        lut[label] = color
+    return lut
+
+
+def vote_confidence(vote_label_pool):
+    """ Share of the votes (or probability mass) of every point that went to its predicted class, float32 """
+    total = np.sum(vote_label_pool, axis=1, dtype=np.float64)
+    best = np.max(vote_label_pool, axis=1)
+    confidence = np.zeros(len(total), dtype=np.float32)
+    np.divide(best, total, out=confidence, where=total > 0, casting='unsafe')
+    return confidence
+
+
+def write_npy(base_path, pred, confidence=None):
+    np.save(base_path + '.npy', pred.astype(np.uint8, copy=False))
+    if confidence is not None:
+        np.save(base_path + '_confidence.npy', confidence.astype(np.float32, copy=False))
+
+
+def write_txt(base_path, pred):
+    np.savetxt(base_path + '.txt', pred, fmt='%d')
+
+
+def write_las(path, points, pred, gt, confidence, source_file=None):
+    """ Write pred, gt and confidence as extra dimensions of a LAS/LAZ file (compressed when path ends in .laz)
+        The input file is copied when it holds exactly these points, otherwise a new file is built from points
+        Input:
+            points: N x 3 float64 file coordinates
+            source_file: LAS/LAZ file the scene was read from
+    """
+    las = laspy.read(source_file) if source_file is not None else None
+    if las is None or len(las.points) != len(pred):
+        header = laspy.LasHeader(point_format=3, version='1.2')
+        header.offsets = np.min(points, axis=0)
+        header.scales = np.array([0.001, 0.001, 0.001])
+        las = laspy.LasData(header)
+        las.x, las.y, las.z = points[:, 0], points[:, 1], points[:, 2]
+
+    dimensions = [('pred', np.uint8), ('gt', np.uint8), ('confidence', np.float32)]
+    existing = set(las.point_format.extra_dimension_names)
+    las.add_extra_dims([laspy.ExtraBytesParams(name=name, type=dtype) for name, dtype in dimensions
+                        if name not in existing])
+    las.pred = pred.astype(np.uint8, copy=False)
+    las.gt = gt.astype(np.uint8, copy=False)
+    las.confidence = confidence.astype(np.float32, copy=False)
+    las.write(path)
+
+
+def write_obj(path, points, colors=None):
+    """ OBJ vertices, with r g b after the position when colors (N x 3 uint8) is given """
+    row = 'v %f %f %f %d %d %d\n' if colors is not None else 'v %f %f %f\n'
+    with open(path, 'w') as fout:
+        for start in range(0, len(points), OBJ_CHUNK_SIZE):
+            chunk = points[start:start + OBJ_CHUNK_SIZE].astype(object)
+            if colors is not None:
+                chunk = np.concatenate([chunk, colors[start:start + OBJ_CHUNK_SIZE].astype(object)], axis=1)
+            fout.write((row * len(chunk)) % tuple(chunk.ravel()))
+
+
+def write_ply(path, points, colors):
+    """ Binary little endian PLY with float64 positions and uint8 colours, one tofile for all vertices """
+    vertex = np.empty(len(points), dtype=[('x', '<f8'), ('y', '<f8'), ('z', '<f8'),
+                                          ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+    vertex['x'], vertex['y'], vertex['z'] = points[:, 0], points[:, 1], points[:, 2]
+    vertex['red'], vertex['green'], vertex['blue'] = colors[:, 0], colors[:, 1], colors[:, 2]
+    header = ('ply\nformat binary_little_endian 1.0\nelement vertex %d\n'
+              'property double x\nproperty double y\nproperty double z\n'
+              'property uchar red\nproperty uchar green\nproperty uchar blue\nend_header\n' % len(points))
+    with open(path, 'wb') as fout:
+        fout.write(header.encode('ascii'))
+        vertex.tofile(fout)
+
+
+class PredictionWriter():
+    """ Write the predictions of one scene in every requested format
+        Input:
+            formats: names from OUTPUT_FORMATS
+            label2color: {label: [r, g, b]} used for obj and ply
+            color: colour obj vertices, positions only otherwise
+    """
+    def __init__(self, formats, label2color, color=True):
+        for output_format in formats:
+            if output_format not in OUTPUT_FORMATS:
+                raise ValueError('Unknown output format %s, choose from %s' % (output_format, ', '.join(OUTPUT_FORMATS)))
+        self.formats = list(formats)
+        self.lut = label_color_lut(label2color)
+        self.color = color
+
+    def write(self, base_path, points, pred, gt, confidence, source_file=None):
+        """
+        Input:
+            base_path: output path without extension
+            points: N x 3 float64 file coordinates
+            pred, gt: N labels
+            confidence: N vote confidences
+            source_file: LAS/LAZ file of the scene, copied by the las and laz formats
+        """
+        for output_format in self.formats:
+            if output_format == 'npy':
+                write_npy(base_path, pred, confidence)
+            elif output_format == 'txt':
+                write_txt(base_path, pred)
+            elif output_format in ('las', 'laz'):
+                write_las(base_path + '_pred.' + output_format, points, pred, gt, confidence, source_file)
+            elif output_format == 'obj':
+                write_obj(base_path + '_pred.obj', points, self.lut[pred] if self.color else None)
+                write_obj(base_path + '_gt.obj', points, self.lut[gt] if self.color else None)
+            elif output_format == 'ply':
+                write_ply(base_path + '_pred.ply', points, self.lut[pred])
+                write_ply(base_path + '_gt.ply', points, self.lut[gt])
@@ -1,5 +1,56 @@
 import numpy as np
 
+# Every function works on the whole batch at once, rotation matrices are built for all B clouds together
+# and applied with one batched matmul. rng: optional np.random.Generator, the global np.random state is
+# used when it is None, so np.random.seed in DataLoader workers keeps working.
+
+def _random(rng):
+    return np.random if rng is None else rng
+
+
+def _rotation_y(angles):
+    """ Bx3x3 rotation matrices around the y axis """
+    cosval, sinval = np.cos(angles), np.sin(angles)
+    R = np.zeros((len(angles), 3, 3))
+    R[:, 0, 0] = cosval
+    R[:, 0, 2] = sinval
+    R[:, 1, 1] = 1
+    R[:, 2, 0] = -sinval
+    R[:, 2, 2] = cosval
+    return R
+
+
+def _rotation_z(angles):
+    """ Bx3x3 rotation matrices around the z axis, applied as points x R """
+    cosval, sinval = np.cos(angles), np.sin(angles)
+    R = np.zeros((len(angles), 3, 3))
+    R[:, 0, 0] = cosval
+    R[:, 0, 1] = sinval
+    R[:, 1, 0] = -sinval
+    R[:, 1, 1] = cosval
+    R[:, 2, 2] = 1
+    return R
+
+
+def _perturbation_rotation(B, angle_sigma, angle_clip, rng):
+    """ Bx3x3 small random rotations Rz . Ry . Rx """
+    angles = np.clip(angle_sigma * _random(rng).standard_normal((B, 3)), -angle_clip, angle_clip)
+    cos, sin = np.cos(angles), np.sin(angles)
+    Rx = np.zeros((B, 3, 3))
+    Rx[:, 0, 0] = 1
+    Rx[:, 1, 1], Rx[:, 1, 2] = cos[:, 0], -sin[:, 0]
+    Rx[:, 2, 1], Rx[:, 2, 2] = sin[:, 0], cos[:, 0]
+    Ry = np.zeros((B, 3, 3))
+    Ry[:, 0, 0], Ry[:, 0, 2] = cos[:, 1], sin[:, 1]
+    Ry[:, 1, 1] = 1
+    Ry[:, 2, 0], Ry[:, 2, 2] = -sin[:, 1], cos[:, 1]
+    Rz = np.zeros((B, 3, 3))
+    Rz[:, 0, 0], Rz[:, 0, 1] = cos[:, 2], -sin[:, 2]
+    Rz[:, 1, 0], Rz[:, 1, 1] = sin[:, 2], cos[:, 2]
+    Rz[:, 2, 2] = 1
+    return np.matmul(Rz, np.matmul(Ry, Rx))
+
+
 def normalize_data(batch_data):
     """ Normalize the batch data, use coordinates of the block centered at origin,
         Input:
@@ -7,19 +58,13 @@ def normalize_data(batch_data):
         Output:
             BxNxC array
     """
-    B, N, C = batch_data.shape
-    normal_data = np.zeros((B, N, C))
-    for b in range(B):
-        pc = batch_data[b]
-        centroid = np.mean(pc, axis=0)
-        pc = pc - centroid
-        m = np.max(np.sqrt(np.sum(pc ** 2, axis=1)))
-        pc = pc / m
-        normal_data[b] = pc
-    return normal_data
-
-
-def shuffle_data(data, labels):
+    pc = batch_data - np.mean(batch_data, axis=1, keepdims=True)
+    m = np.max(np.sqrt(np.sum(pc ** 2, axis=2)), axis=1)
+    normal_data = pc / m[:, np.newaxis, np.newaxis]
+    return normal_data.astype(np.float64, copy=False)
+
+
+def shuffle_data(data, labels, rng=None):
     """ Shuffle data and labels.
         Input:
           data: B,N,... numpy array
@@ -28,10 +73,10 @@ def shuffle_data(data, labels):
           shuffled data, label and shuffle indices
     """
     idx = np.arange(len(labels))
-    np.random.shuffle(idx)
+    _random(rng).shuffle(idx)
     return data[idx, ...], labels[idx], idx
 
-def shuffle_points(batch_data):
+def shuffle_points(batch_data, rng=None):
     """ Shuffle orders of points in each point cloud -- changes FPS behavior.
         Use the same shuffling idx for the entire batch.
         Input:
@@ -40,10 +85,10 @@ def shuffle_points(batch_data):
             BxNxC array
     """
     idx = np.arange(batch_data.shape[1])
-    np.random.shuffle(idx)
+    _random(rng).shuffle(idx)
     return batch_data[:,idx,:]
 
-def rotate_point_cloud(batch_data):
+def rotate_point_cloud(batch_data, rng=None):
     """ Randomly rotate the point clouds to augument the dataset
         rotation is per shape based along up direction
         Input:
@@ -51,19 +96,10 @@ def rotate_point_cloud(batch_data):
         Return:
           BxNx3 array, rotated batch of point clouds
     """
-    rotated_data = np.zeros(batch_data.shape, dtype=np.float32)
-    for k in range(batch_data.shape[0]):
-        rotation_angle = np.random.uniform() * 2 * np.pi
-        cosval = np.cos(rotation_angle)
-        sinval = np.sin(rotation_angle)
-        rotation_matrix = np.array([[cosval, 0, sinval],
-                                    [0, 1, 0],
-                                    [-sinval, 0, cosval]])
-        shape_pc = batch_data[k, ...]
-        rotated_data[k, ...] = np.dot(shape_pc.reshape((-1, 3)), rotation_matrix)
-    return rotated_data
+    angles = _random(rng).uniform(size=batch_data.shape[0]) * 2 * np.pi
+    return np.matmul(batch_data, _rotation_y(angles)).astype(np.float32)
 
-def rotate_point_cloud_z(batch_data):
+def rotate_point_cloud_z(batch_data, rng=None):
     """ Randomly rotate the point clouds to augument the dataset
         rotation is per shape based along up direction
         Input:
@@ -71,62 +107,33 @@ def rotate_point_cloud_z(batch_data):
         Return:
           BxNx3 array, rotated batch of point clouds
     """
-    rotated_data = np.zeros(batch_data.shape, dtype=np.float32)
-    for k in range(batch_data.shape[0]):
-        rotation_angle = np.random.uniform() * 2 * np.pi
-        cosval = np.cos(rotation_angle)
-        sinval = np.sin(rotation_angle)
-        rotation_matrix = np.array([[cosval, sinval, 0],
-                                    [-sinval, cosval, 0],
-                                    [0, 0, 1]])
-        shape_pc = batch_data[k, ...]
-        rotated_data[k, ...] = np.dot(shape_pc.reshape((-1, 3)), rotation_matrix)
-    return rotated_data
+    angles = _random(rng).uniform(size=batch_data.shape[0]) * 2 * np.pi
+    return np.matmul(batch_data, _rotation_z(angles)).astype(np.float32)
 
-def rotate_point_cloud_with_normal(batch_xyz_normal):
+def rotate_point_cloud_with_normal(batch_xyz_normal, rng=None):
     ''' Randomly rotate XYZ, normal point cloud.
         Input:
             batch_xyz_normal: B,N,6, first three channels are XYZ, last 3 all normal
         Output:
             B,N,6, rotated XYZ, normal point cloud
     '''
-    for k in range(batch_xyz_normal.shape[0]):
-        rotation_angle = np.random.uniform() * 2 * np.pi
-        cosval = np.cos(rotation_angle)
-        sinval = np.sin(rotation_angle)
-        rotation_matrix = np.array([[cosval, 0, sinval],
-                                    [0, 1, 0],
-                                    [-sinval, 0, cosval]])
-        shape_pc = batch_xyz_normal[k,:,0:3]
-        shape_normal = batch_xyz_normal[k,:,3:6]
-        batch_xyz_normal[k,:,0:3] = np.dot(shape_pc.reshape((-1, 3)), rotation_matrix)
-        batch_xyz_normal[k,:,3:6] = np.dot(shape_normal.reshape((-1, 3)), rotation_matrix)
+    angles = _random(rng).uniform(size=batch_xyz_normal.shape[0]) * 2 * np.pi
+    R = _rotation_y(angles)
+    batch_xyz_normal[:,:,0:3] = np.matmul(batch_xyz_normal[:,:,0:3], R)
+    batch_xyz_normal[:,:,3:6] = np.matmul(batch_xyz_normal[:,:,3:6], R)
     return batch_xyz_normal
 
-def rotate_perturbation_point_cloud_with_normal(batch_data, angle_sigma=0.06, angle_clip=0.18):
+def rotate_perturbation_point_cloud_with_normal(batch_data, angle_sigma=0.06, angle_clip=0.18, rng=None):
     """ Randomly perturb the point clouds by small rotations
         Input:
           BxNx6 array, original batch of point clouds and point normals
         Return:
           BxNx3 array, rotated batch of point clouds
     """
+    R = _perturbation_rotation(batch_data.shape[0], angle_sigma, angle_clip, rng)
     rotated_data = np.zeros(batch_data.shape, dtype=np.float32)
-    for k in range(batch_data.shape[0]):
-        angles = np.clip(angle_sigma*np.random.randn(3), -angle_clip, angle_clip)
-        Rx = np.array([[1,0,0],
-                       [0,np.cos(angles[0]),-np.sin(angles[0])],
-                       [0,np.sin(angles[0]),np.cos(angles[0])]])
-        Ry = np.array([[np.cos(angles[1]),0,np.sin(angles[1])],
-                       [0,1,0],
-                       [-np.sin(angles[1]),0,np.cos(angles[1])]])
-        Rz = np.array([[np.cos(angles[2]),-np.sin(angles[2]),0],
-                       [np.sin(angles[2]),np.cos(angles[2]),0],
-                       [0,0,1]])
-        R = np.dot(Rz, np.dot(Ry,Rx))
-        shape_pc = batch_data[k,:,0:3]
-        shape_normal = batch_data[k,:,3:6]
-        rotated_data[k,:,0:3] = np.dot(shape_pc.reshape((-1, 3)), R)
-        rotated_data[k,:,3:6] = np.dot(shape_normal.reshape((-1, 3)), R)
+    rotated_data[:,:,0:3] = np.matmul(batch_data[:,:,0:3], R)
+    rotated_data[:,:,3:6] = np.matmul(batch_data[:,:,3:6], R)
     return rotated_data
 
 
@@ -137,16 +144,9 @@ def rotate_point_cloud_by_angle(batch_data, rotation_angle):
         Return:
           BxNx3 array, rotated batch of point clouds
     """
+    R = _rotation_y(np.array([rotation_angle]))[0]
     rotated_data = np.zeros(batch_data.shape, dtype=np.float32)
-    for k in range(batch_data.shape[0]):
-        #rotation_angle = np.random.uniform() * 2 * np.pi
-        cosval = np.cos(rotation_angle)
-        sinval = np.sin(rotation_angle)
-        rotation_matrix = np.array([[cosval, 0, sinval],
-                                    [0, 1, 0],
-                                    [-sinval, 0, cosval]])
-        shape_pc = batch_data[k,:,0:3]
-        rotated_data[k,:,0:3] = np.dot(shape_pc.reshape((-1, 3)), rotation_matrix)
+    rotated_data[:,:,0:3] = np.matmul(batch_data[:,:,0:3], R)
     return rotated_data
 
 def rotate_point_cloud_by_angle_with_normal(batch_data, rotation_angle):
@@ -157,48 +157,26 @@ def rotate_point_cloud_by_angle_with_normal(batch_data, rotation_angle):
         Return:
           BxNx6 array, rotated batch of point clouds iwth normal
     """
+    R = _rotation_y(np.array([rotation_angle]))[0]
     rotated_data = np.zeros(batch_data.shape, dtype=np.float32)
-    for k in range(batch_data.shape[0]):
-        #rotation_angle = np.random.uniform() * 2 * np.pi
-        cosval = np.cos(rotation_angle)
-        sinval = np.sin(rotation_angle)
-        rotation_matrix = np.array([[cosval, 0, sinval],
-                                    [0, 1, 0],
-                                    [-sinval, 0, cosval]])
-        shape_pc = batch_data[k,:,0:3]
-        shape_normal = batch_data[k,:,3:6]
-        rotated_data[k,:,0:3] = np.dot(shape_pc.reshape((-1, 3)), rotation_matrix)
-        rotated_data[k,:,3:6] = np.dot(shape_normal.reshape((-1,3)), rotation_matrix)
+    rotated_data[:,:,0:3] = np.matmul(batch_data[:,:,0:3], R)
+    rotated_data[:,:,3:6] = np.matmul(batch_data[:,:,3:6], R)
     return rotated_data
 
 
 
-def rotate_perturbation_point_cloud(batch_data, angle_sigma=0.06, angle_clip=0.18):
+def rotate_perturbation_point_cloud(batch_data, angle_sigma=0.06, angle_clip=0.18, rng=None):
     """ Randomly perturb the point clouds by small rotations
         Input:
           BxNx3 array, original batch of point clouds
         Return:
           BxNx3 array, rotated batch of point clouds
     """
-    rotated_data = np.zeros(batch_data.shape, dtype=np.float32)
-    for k in range(batch_data.shape[0]):
-        angles = np.clip(angle_sigma*np.random.randn(3), -angle_clip, angle_clip)
-        Rx = np.array([[1,0,0],
-                       [0,np.cos(angles[0]),-np.sin(angles[0])],
-                       [0,np.sin(angles[0]),np.cos(angles[0])]])
-        Ry = np.array([[np.cos(angles[1]),0,np.sin(angles[1])],
-                       [0,1,0],
-                       [-np.sin(angles[1]),0,np.cos(angles[1])]])
-        Rz = np.array([[np.cos(angles[2]),-np.sin(angles[2]),0],
-                       [np.sin(angles[2]),np.cos(angles[2]),0],
-                       [0,0,1]])
-        R = np.dot(Rz, np.dot(Ry,Rx))
-        shape_pc = batch_data[k, ...]
-        rotated_data[k, ...] = np.dot(shape_pc.reshape((-1, 3)), R)
-    return rotated_data
+    R = _perturbation_rotation(batch_data.shape[0], angle_sigma, angle_clip, rng)
+    return np.matmul(batch_data, R).astype(np.float32)
 
 
-def jitter_point_cloud(batch_data, sigma=0.01, clip=0.05):
+def jitter_point_cloud(batch_data, sigma=0.01, clip=0.05, rng=None):
     """ Randomly jitter points. jittering is per point.
         Input:
           BxNx3 array, original batch of point clouds
@@ -207,11 +185,11 @@ def jitter_point_cloud(batch_data, sigma=0.01, clip=0.05):
     """
     B, N, C = batch_data.shape
     assert(clip > 0)
-    jittered_data = np.clip(sigma * np.random.randn(B, N, C), -1*clip, clip)
+    jittered_data = np.clip(sigma * _random(rng).standard_normal((B, N, C)), -1*clip, clip)
     jittered_data += batch_data
     return jittered_data
 
-def shift_point_cloud(batch_data, shift_range=0.1):
+def shift_point_cloud(batch_data, shift_range=0.1, rng=None):
     """ Randomly shift point cloud. Shift is per point cloud.
         Input:
           BxNx3 array, original batch of point clouds
@@ -219,13 +197,12 @@ def shift_point_cloud(batch_data, shift_range=0.1):
           BxNx3 array, shifted batch of point clouds
     """
     B, N, C = batch_data.shape
-    shifts = np.random.uniform(-shift_range, shift_range, (B,3))
-    for batch_index in range(B):
-        batch_data[batch_index,:,:] += shifts[batch_index,:]
+    shifts = _random(rng).uniform(-shift_range, shift_range, (B,3))
+    batch_data += shifts[:, np.newaxis, :]
     return batch_data
 
 
-def random_scale_point_cloud(batch_data, scale_low=0.8, scale_high=1.25):
+def random_scale_point_cloud(batch_data, scale_low=0.8, scale_high=1.25, rng=None):
     """ Randomly scale the point cloud. Scale is per point cloud.
         Input:
             BxNx3 array, original batch of point clouds
@@ -233,19 +210,14 @@ def random_scale_point_cloud(batch_data, scale_low=0.8, scale_high=1.25):
             BxNx3 array, scaled batch of point clouds
     """
     B, N, C = batch_data.shape
-    scales = np.random.uniform(scale_low, scale_high, B)
-    for batch_index in range(B):
-        batch_data[batch_index,:,:] *= scales[batch_index]
+    scales = _random(rng).uniform(scale_low, scale_high, B)
+    batch_data *= scales[:, np.newaxis, np.newaxis]
     return batch_data
 
-def random_point_dropout(batch_pc, max_dropout_ratio=0.875):
+def random_point_dropout(batch_pc, max_dropout_ratio=0.875, rng=None):
     ''' batch_pc: BxNx3 '''
-    for b in range(batch_pc.shape[0]):
-        dropout_ratio =  np.random.random()*max_dropout_ratio # 0~0.875
-        drop_idx = np.where(np.random.random((batch_pc.shape[1]))<=dropout_ratio)[0]
-        if len(drop_idx)>0:
-            batch_pc[b,drop_idx,:] = batch_pc[b,0,:] # set to the first point
+    B, N = batch_pc.shape[0], batch_pc.shape[1]
+    dropout_ratio = _random(rng).random(B) * max_dropout_ratio # 0~0.875
+    drop = _random(rng).random((B, N)) <= dropout_ratio[:, np.newaxis]
+    batch_pc[drop] = np.broadcast_to(batch_pc[:, 0:1, :], batch_pc.shape)[drop] # set to the first point
     return batch_pc
-
-
-